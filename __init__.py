@@ -1,6 +1,12 @@
 #from pysugar import *
-from pysugar import __version__, SugarSession
+from pysugar import __version__, SugarSession, SugarSessionStore
 import pysugar
 from sugarstore import SugarStore
+from sugartransport import SugarConnectionPool
+from sugarpool import SugarSessionPool, SugarPriorityScheduler
+from asyncsugar import AsyncSugarSession
+from sugarlimit import SugarConcurrencyLimiter, SugarBatchSizer
+from sugarcache import SugarEntryCache, SugarQueryCache, \
+        SugarSQLiteCache, SugarDjangoCache
 
 # vim: noexpandtab tabstop=4 shiftwidth=4:
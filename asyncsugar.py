@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Asynchronous sessions for the pysugar library, built on asyncore so
+# that one thread can keep many SOAP calls in flight
+#
+import asyncore
+import asynchat
+import socket
+import sys
+import time
+import urlparse
+import httplib
+from collections import deque
+from elementtree import ElementTree
+from pysugar import SugarService, SugarError, SugarConnectError, \
+        SugarInvalidSessionError, soap_envelope, soap_result
+
+DefaultMaxInFlight = 20
+DefaultTimeout = 60
+
+class SugarAsyncCall(object):
+    '''
+    The pending result of a call made with an AsyncSugarSession. The
+    call is sent when the session runs (see AsyncSugarSession.gather
+    and AsyncSugarSession.run), result() then gives its return value
+    or raises its error.
+    '''
+    def __init__(self, action, build, parse, needs_session=True):
+        self.action = action
+        # build(session_id) returns the request element,
+        # parse(element) the value of the call
+        self.build = build
+        self.parse = parse
+        self.needs_session = needs_session
+        # the session id the call was last sent with
+        self.session_id = None
+        self.retried = False
+        self.finished = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if not self.finished:
+            raise SugarError('the %s call is not finished' % self.action)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def add_callback(self, fn):
+        '''
+        fn(call) is called once the call is finished
+        '''
+        if self.finished:
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+
+    def _finish(self, value=None, exc_info=None):
+        self.finished = True
+        self.value = value
+        self.exc_info = exc_info
+        callbacks = self.callbacks
+        self.callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+class SugarHTTPChannel(asynchat.async_chat):
+    '''
+    Posts one SOAP request and reads the answer. The server is asked
+    to close the connection after answering, so the end of the answer
+    is either its Content-Length or the end of the stream.
+    '''
+    def __init__(self, session, call, body):
+        asynchat.async_chat.__init__(self, map=session.map)
+        self.session = session
+        self.call = call
+        self.deadline = time.time() + session.timeout
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.data = []
+        self.finished = False
+
+        self.set_terminator('\r\n\r\n')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((session.host, session.port))
+        self.push('\r\n'.join([
+                'POST %s HTTP/1.0' % session.path,
+                'Host: %s' % session.host,
+                'Content-Type: text/xml',
+                'Content-Length: %d' % len(body),
+                'SOAPAction: %s' % call.action,
+                'Connection: close',
+                '', '']) + body)
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+
+    def found_terminator(self):
+        if self.headers is not None:
+            # the whole body announced by the Content-Length is there
+            self._finish()
+            return
+
+        lines = ''.join(self.data).split('\r\n')
+        self.data = []
+        status_line = lines[0].split(None, 2)
+        if len(status_line) < 2 or not status_line[1].isdigit():
+            raise httplib.BadStatusLine(lines[0])
+        self.status = int(status_line[1])
+        self.reason = status_line[2:] and status_line[2] or ''
+        self.headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+
+        length = self.headers.get('content-length')
+        if length is None or not length.isdigit():
+            self.set_terminator(None)
+        elif int(length) == 0:
+            self._finish()
+        else:
+            self.set_terminator(int(length))
+
+    def handle_close(self):
+        if self.headers is None:
+            self._finish(SugarConnectError(
+                    'connection closed before the answer of %s'
+                    % self.call.action))
+        else:
+            self._finish()
+
+    def handle_error(self):
+        self._finish(exc_info=sys.exc_info())
+
+    def expire(self, now):
+        if now > self.deadline:
+            self._finish(SugarConnectError('the %s call timed out after '
+                    '%s seconds' % (self.call.action, self.session.timeout)))
+
+    def _finish(self, error=None, exc_info=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.close()
+        if error is not None:
+            try:
+                raise error
+            except SugarError:
+                exc_info = sys.exc_info()
+        self.session._answered(self, ''.join(self.data), exc_info)
+
+class AsyncSugarSession(object):
+    '''
+    Mirrors the SugarSession calls that matter for fan-out work, but the
+    methods return SugarAsyncCall objects instead of waiting for the
+    answer. All the calls are run by a single thread, with up to
+    max_in_flight requests on the wire at the same time:
+
+        s = AsyncSugarSession('myuser', 'mypass', 'http://myserver/sugar')
+        calls = [s.get_entry('Leads', id, ['last_name']) for id in ids]
+        leads = s.gather(calls)
+
+    The login is made when the first call needs a session id, or
+    explicitly with s.gather([s.login()]). A call rejected because the
+    session expired logs in again and is retried once, like SugarSession
+    does.
+
+    The requests are built and the answers parsed by the same code as
+    the SugarService calls. Only plain http urls are supported.
+
+    max_in_flight: the maximum number of requests sent and not yet
+        answered
+    timeout: how long (in seconds) a request may wait for its answer
+    '''
+    # how often the loop wakes up to look for timed out requests
+    poll_interval = 0.1
+
+    def __init__(self, username, password, base_url, nusoapfile='soap.php',
+            max_in_flight=DefaultMaxInFlight, timeout=DefaultTimeout):
+        self.base_url = base_url
+        self.url = base_url + '/' + nusoapfile
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(self.url)
+        if scheme != 'http':
+            raise ValueError('unsupported url scheme: %s' % scheme)
+        host, sep, port = netloc.rpartition(':')
+        if not sep or not port.isdigit():
+            host, port = netloc, httplib.HTTP_PORT
+        self.host = host
+        self.port = int(port)
+        if query:
+            path = '%s?%s' % (path, query)
+        self.path = path or '/'
+
+        self._username = username
+        self._password = password
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        # builds the requests and parses the answers, it never sends
+        # anything itself
+        self.service = SugarService(self.url)
+
+        self._session_id = None
+        self._login_call = None
+        self.map = {}
+        self.queue = deque()
+        self.channels = []
+        self.stats = {
+                'calls': 0,
+                'retried': 0,
+                'errors': 0,
+                'max_in_flight': 0,
+                }
+
+    def _submit(self, call):
+        self.stats['calls'] += 1
+        self.queue.append(call)
+        return call
+
+    def _session_call(self, action, build, parse):
+        return self._submit(SugarAsyncCall(action, build, parse))
+
+    def login(self):
+        '''
+        opens a new session with the credentials of the constructor
+        '''
+        def logged_in(response):
+            self._session_id = self.service.login_result(response)
+            return self._session_id
+
+        call = SugarAsyncCall('login',
+                lambda session_id: self.service.login_request(
+                    self._username, self._password),
+                logged_in, False)
+        self._login_call = call
+        call.add_callback(self._login_done)
+        # the login goes before the calls waiting for it
+        self.stats['calls'] += 1
+        self.queue.appendleft(call)
+        return call
+
+    def _login_done(self, call):
+        if self._login_call is call:
+            self._login_call = None
+        if call.exc_info is None:
+            return
+        # nothing waiting for a session can succeed
+        waiting = [c for c in self.queue if c.needs_session]
+        self.queue = deque([c for c in self.queue if not c.needs_session])
+        for c in waiting:
+            c._finish(exc_info=call.exc_info)
+
+    def get_entry(self, module, id, selection):
+        return self._session_call('get_entry',
+                lambda session_id: self.service.get_entry_request(
+                    session_id, module, id, selection),
+                self.service.get_entry_result)
+
+    def get_entry_list(self, module, query, order_by,
+            offset, selection, max_result, deleted):
+        return self._session_call('get_entry_list',
+                lambda session_id: self.service.get_entry_list_request(
+                    session_id, module, query, order_by, offset,
+                    selection, max_result, deleted),
+                self.service.get_entry_list_result)
+
+    def set_entries(self, module, items):
+        return self._session_call('set_entries',
+                lambda session_id: self.service.set_entries_request(
+                    session_id, module, items),
+                self.service.set_entries_result)
+
+    def get_relationships(self, module_name, module_id, related_module,
+            related_module_query, deleted=False):
+        return self._session_call('get_relationships',
+                lambda session_id: self.service.get_relationships_request(
+                    session_id, module_name, module_id, related_module,
+                    related_module_query, deleted),
+                self.service.get_relationships_result)
+
+    def set_relationship(self, module1, module1_id, module2, module2_id):
+        return self._session_call('set_relationships',
+                lambda session_id: self.service.set_relationship_request(
+                    session_id, module1, module1_id, module2, module2_id),
+                self.service.set_relationship_result)
+
+    def _start(self, limit):
+        '''
+        send the queued calls that can go, within limit
+        '''
+        while self.queue and len(self.channels) < limit:
+            call = self.queue[0]
+            if call.needs_session and not self._session_id:
+                if self._login_call is None:
+                    self.login()
+                    continue
+                # wait for the login to be answered
+                return
+            self.queue.popleft()
+            try:
+                body = soap_envelope(call.build(self._session_id))
+                call.session_id = self._session_id
+                self.channels.append(SugarHTTPChannel(self, call, body))
+            except Exception:
+                self.stats['errors'] += 1
+                call._finish(exc_info=sys.exc_info())
+        if len(self.channels) > self.stats['max_in_flight']:
+            self.stats['max_in_flight'] = len(self.channels)
+
+    def _answered(self, channel, body, exc_info):
+        self.channels.remove(channel)
+        call = channel.call
+        if exc_info is None:
+            try:
+                if channel.status not in (200, 500):
+                    raise SugarConnectError('HTTP error %s: %s' % (
+                            channel.status, channel.reason))
+                response = soap_result(ElementTree.XML(body), call.action)
+                value = call.parse(response)
+            except SugarInvalidSessionError:
+                exc_info = sys.exc_info()
+                if not call.retried:
+                    call.retried = True
+                    self.stats['retried'] += 1
+                    if self._session_id == call.session_id:
+                        self._session_id = None
+                    self.queue.appendleft(call)
+                    return
+            except Exception:
+                exc_info = sys.exc_info()
+        if exc_info is not None:
+            self.stats['errors'] += 1
+            call._finish(exc_info=exc_info)
+        else:
+            call._finish(value)
+
+    def run(self, calls=None, limit=None):
+        '''
+        runs the event loop until the given calls, or all the queued
+        ones, are finished. At most limit requests (by default
+        max_in_flight) are on the wire at the same time.
+        '''
+        limit = limit or self.max_in_flight
+        while True:
+            if calls is None:
+                pending = self.queue or self.channels
+            else:
+                pending = [c for c in calls if not c.finished]
+            if not pending:
+                return
+            self._start(limit)
+            if not self.channels:
+                if calls is not None and not [c for c in pending
+                        if c in self.queue]:
+                    raise SugarError('calls of another session cannot '
+                            'be run by this one')
+                continue
+            asyncore.loop(self.poll_interval, False, self.map, 1)
+            now = time.time()
+            for channel in self.channels[:]:
+                channel.expire(now)
+
+    def gather(self, calls, limit=None, return_exceptions=False):
+        '''
+        runs the given calls with at most limit of them in flight and
+        returns their results, in the same order. The first error is
+        raised, unless return_exceptions is True in which case errors
+        are returned in place of the results.
+        '''
+        calls = list(calls)
+        self.run(calls, limit)
+        results = []
+        for call in calls:
+            if call.exc_info is not None and return_exceptions:
+                results.append(call.exc_info[1])
+            else:
+                results.append(call.result())
+        return results
+
+    def get_stats(self):
+        '''
+        returns a dictionnary with the number of calls made, retried
+        after a new login and failed, the largest number of requests
+        that were in flight together and the current number of queued
+        and in flight calls
+        '''
+        stats = dict(self.stats)
+        stats['queued'] = len(self.queue)
+        stats['in_flight'] = len(self.channels)
+        return stats
+
+# vim: expandtab tabstop=4 shiftwidth=4:
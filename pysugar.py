@@ -4,7 +4,8 @@
 # for full text of the license
 #
 from elementsoap import ElementSOAP
-from elementtree.ElementTree import tostring, dump
+from elementtree import ElementTree
+from elementtree.ElementTree import tostring, dump, iterparse
 import md5
 import xml
 from pytz import timezone
@@ -12,6 +13,18 @@ import datetime
 import base64
 import urllib2
 import types
+import os
+import json
+import threading
+import itertools
+try:
+    import fcntl
+except ImportError:
+    # no file locking on this platform, see SugarSessionStore
+    fcntl = None
+from sugartransport import SugarConnectionPool
+from sugarcache import SugarSingleFlight, selection_key, copy_result
+import sugarpaging
 from pysugar_version import version, major_version, minor_version, mid_version
 
 __version__ = version
@@ -20,6 +33,9 @@ __doc__ = '''This is the transport layer for the pysugar library.
 It uses ElementSOAP in order to communicate with the Sugar NuSoap Server.
 '''
 
+# the error number sent back for calls made with an unknown session id
+InvalidSessionError = 11
+
 def item_to_name_value(item):
     '''
     takes a real item dictionnary and prepare it for soap
@@ -49,6 +65,30 @@ def name_value_to_item(nv_list):
 
     return item
         
+def add_selection(request, name, type, selection):
+    '''
+    adds the fields selection to a request. selection is either a list
+    of field names, sent as an array, or a string sent as is ('' asks
+    for all the fields)
+    '''
+    if isinstance(selection, (types.ListType, types.TupleType)):
+        fields = ElementSOAP.SoapElement(request, name, "Array")
+        for field in selection:
+            ElementSOAP.SoapElement(fields, 'item', 'string', field)
+    else:
+        ElementSOAP.SoapElement(request, name, type, selection)
+
+def entry_values(entry):
+    '''
+    takes an entry element from a sugar answer and returns a 2-tuple
+    with the id of the entry and an iterator over its (name, value)
+    pairs, without building a dictionnary
+    '''
+    nv = entry.find('name_value_list')
+    pairs = ((el.findtext('name'), el.findtext('value'))
+            for el in nv.findall('item'))
+    return (entry.findtext('id'), pairs)
+
 class SugarError(Exception):
     '''
     This is the base class for our errors
@@ -80,6 +120,13 @@ class SugarCredentialError(SugarError):
     '''
     pass
 
+class SugarInvalidSessionError(SugarCredentialError):
+    '''
+    raised when the server answers that the session id is not (or no
+    longer) valid
+    '''
+    pass
+
 class SugarVersionError(SugarError):
     '''
     If an error occurs on the version number
@@ -99,6 +146,183 @@ class SugarDataError(SugarError):
     '''
     pass
 
+class SugarEntryList(list):
+    '''
+    the list of entries returned by get_entry_list along with the
+    paging information sent by the server
+    '''
+    result_count = None
+    next_offset = None
+    total_count = None
+
+def local_tag(tag):
+    '''
+    strips the {namespace} part of an element tag
+    '''
+    if tag[:1] == '{':
+        return tag.split('}', 1)[1]
+    return tag
+
+def check_fault(element):
+    '''
+    raise an ElementSOAP.SoapFault if element is a SOAP fault
+    '''
+    if local_tag(element.tag) == "Fault":
+        raise ElementSOAP.SoapFault(
+                element.findtext("faultcode"),
+                element.findtext("faultstring"),
+                element.findtext("faultactor"),
+                element.find("detail"))
+
+# how NuSOAP and the PHP SOAP extension word the faults about an
+# unknown method
+UnknownMethodFaults = ('not defined', "doesn't exist", 'not present')
+
+def is_unknown_method(fault):
+    '''
+    tells if the SoapFault fault means that the server does not provide
+    the called method, as opposed to an error while running it
+    '''
+    faultstring = fault.args[1:2] and fault.args[1] or ''
+    if not isinstance(faultstring, basestring):
+        return False
+    faultstring = faultstring.lower()
+    for text in UnknownMethodFaults:
+        if text in faultstring:
+            return True
+    return False
+
+def check_error(error_elem):
+    '''
+    raise a SugarError if the error element of an answer holds a non
+    zero error number, a SugarInvalidSessionError when the server does
+    not know the session id
+    '''
+    error = int(error_elem.findtext('number'))
+    if not error:
+        return
+    name = error_elem.findtext('name')
+    desc = error_elem.findtext('description')
+    msg = 'number: %s, name: "%s", desc: "%s"' % (error, name, desc)
+    if error == InvalidSessionError:
+        raise SugarInvalidSessionError(msg)
+    raise SugarError(msg)
+
+def soap_envelope(request):
+    '''
+    returns the SOAP envelope holding request, as a string
+    '''
+    envelope = ElementTree.Element(ElementSOAP.NS_SOAP_ENV + "Envelope")
+    body = ElementTree.SubElement(envelope, ElementSOAP.NS_SOAP_ENV + "Body")
+    body.append(request)
+    return tostring(envelope)
+
+def soap_result(envelope, action):
+    '''
+    returns the first element of the body of a SOAP answer, envelope
+    being its parsed tree or root element
+    '''
+    body = envelope.find(ElementSOAP.NS_SOAP_ENV + "Body")
+    if body is None or not len(body):
+        raise SugarDataError('Empty SOAP response for %s' % action)
+    result = body[0]
+    check_fault(result)
+    return result
+
+class SugarEntryListStream(object):
+    '''
+    Iterates over the entries of a get_entry_list response while it is
+    being read from the socket. Each entry is decoded as soon as its
+    closing tag arrives and its element is dropped from the tree,
+    so only one entry is held in memory at a time.
+
+    result_count and next_offset are filled in as soon as they are
+    parsed. The server sends the error block after the entry list,
+    so an error is only raised once the entries have been consumed.
+
+    The stream holds a pooled connection until it is exhausted, fails
+    or is closed. To stop iterating early, use the stream in a with
+    block (or call close() in a finally clause), the connection is
+    otherwise only given back when the stream is garbage collected:
+
+        with s.stream_entry_list('Leads', '', '', 0, '', 1000, 0) as stream:
+            for item in stream:
+                ...
+    '''
+    def __init__(self, response, decode=name_value_to_item):
+        self.response = response
+        self._done = False
+        self.decode = decode
+        self.result_count = None
+        self.next_offset = None
+        self._events = iterparse(response, events=('start', 'end'))
+        self._stack = []
+        self._entry_list = None
+        self._error = None
+        self._fault = None
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if not self._done:
+            self.close()
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+
+        try:
+            for event, elem in self._events:
+                tag = local_tag(elem.tag)
+                if event == 'start':
+                    if tag == 'entry_list' and self._stack[-1:] == ['return']:
+                        self._entry_list = elem
+                    self._stack.append(tag)
+                    continue
+
+                self._stack.pop()
+                parent = self._stack[-1:]
+                if parent == ['entry_list'] and tag == 'item':
+                    item = self.decode(elem)
+                    self._entry_list.remove(elem)
+                    return item
+                elif parent == ['return']:
+                    if tag == 'result_count':
+                        self.result_count = int(elem.text)
+                    elif tag == 'next_offset':
+                        self.next_offset = int(elem.text)
+                    elif tag == 'error':
+                        self._error = elem
+                elif tag == 'Fault':
+                    self._fault = elem
+        except:
+            self.close()
+            raise
+
+        self.close()
+
+        if self._fault is not None:
+            check_fault(self._fault)
+
+        if self._error is not None:
+            check_error(self._error)
+
+        raise StopIteration
+
+    def close(self):
+        '''
+        stop reading the response and give the connection back
+        '''
+        self._done = True
+        self.response.release()
+
 class SugarService(ElementSOAP.SoapService):
     '''
     This is the transport part of pysugar, it implements the soap
@@ -107,11 +331,52 @@ class SugarService(ElementSOAP.SoapService):
     End-users should prefer to use the SugarSession class
     that encapsulates the notion of session and takes care of
     providing the session_id to the underlying sugar service
+
+    All the calls go through a SugarConnectionPool so that consecutive
+    calls reuse the same keep-alive connections. A pool can be given
+    to share connections between several services, otherwise each
+    service gets its own.
     '''
-    def __init__(self, url):
+    def __init__(self, url, connection_pool=None):
         self.url = url
         self.application_name = "pysugar"
         ElementSOAP.SoapService.__init__(self, url)
+        if connection_pool is None:
+            connection_pool = SugarConnectionPool()
+        self.connection_pool = connection_pool
+
+    def _send(self, action, request):
+        '''
+        wraps the request in a SOAP envelope and posts it on a pooled
+        connection. Returns the SugarPooledResponse, the caller
+        must release() it after reading.
+        '''
+        response = self.connection_pool.request(self.url,
+                soap_envelope(request),
+                {'Content-Type': 'text/xml', 'SOAPAction': action})
+
+        # a 500 may still carry a SOAP fault we want to parse
+        if response.status not in (200, 500):
+            response.read()
+            response.release()
+            raise SugarConnectError('HTTP error %s: %s' % (
+                    response.status, response.reason))
+
+        return response
+
+    def call(self, action, request):
+        '''
+        replaces ElementSOAP.SoapService.call which opens a new
+        connection for each call.
+        Returns the first element of the SOAP body.
+        '''
+        response = self._send(action, request)
+        try:
+            tree = ElementTree.parse(response)
+        finally:
+            response.release()
+
+        return soap_result(tree, action)
     
     def login(self, user, password):
         """
@@ -120,17 +385,25 @@ class SugarService(ElementSOAP.SoapService):
 
         if an error occurs, a SugarLoginError is raised.
         """
+        return self.login_result(self.call('login',
+                self.login_request(user, password)))
+
+    # The request building and answer parsing of the calls also used by
+    # the asynchronous sessions (see asyncsugar) are split in
+    # <action>_request and <action>_result methods.
+
+    def login_request(self, user, password):
         pass_hash = md5.new(password).hexdigest()
-        action = 'login'
-        request = ElementSOAP.SoapRequest(action)
+        request = ElementSOAP.SoapRequest('login')
         user_auth = ElementSOAP.SoapElement(request, "user_auth")
         ElementSOAP.SoapElement(user_auth, "user_name", "string", user)
         ElementSOAP.SoapElement(user_auth, "password", "string", pass_hash)
         ElementSOAP.SoapElement(user_auth, "version", "string", '1.2')
         ElementSOAP.SoapElement(request, "application_name",
                 "string", self.application_name)
-        
-        response = self.call(action, request)
+        return request
+
+    def login_result(self, response):
         result = response.find('return')
         error_element = result.find('error')
         if not error_element.findtext('number') == '0':
@@ -229,13 +502,7 @@ class SugarService(ElementSOAP.SoapService):
         ret = response.find('return')
 
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         return ret.findtext('id')
     
@@ -243,8 +510,11 @@ class SugarService(ElementSOAP.SoapService):
         '''
         create multiple entries at the same time in the specified module
         '''
-        action = 'set_entries'
-        request = ElementSOAP.SoapRequest(action)
+        return self.set_entries_result(self.call('set_entries',
+                self.set_entries_request(session_id, module, items)))
+
+    def set_entries_request(self, session_id, module, items):
+        request = ElementSOAP.SoapRequest('set_entries')
         ElementSOAP.SoapElement(request, "session", "string", session_id)
         ElementSOAP.SoapElement(request, "module", "string", module)
         vlists = ElementSOAP.SoapElement(request, "name_value_lists", "Array")
@@ -256,18 +526,13 @@ class SugarService(ElementSOAP.SoapService):
                 ElementSOAP.SoapElement(item_el, 'value', 'string', item[key])
 
         #print tostring(request)
-        
-        response = self.call(action, request)
+        return request
+
+    def set_entries_result(self, response):
         ret = response.find('return')
 
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         ids_el = ret.find('ids').findall('item')
         ids = []
@@ -283,40 +548,87 @@ class SugarService(ElementSOAP.SoapService):
         an to ask for a specific object by id
         the select_fields is a way to ask for only
         some fields to be returned instead
-        of the whole object : currently does nothing...
+        of the whole object: a list of field names, or '' for
+        all of them
 
         In case of error this module will raise a SugarError exception
         '''
-        action = 'get_entry'
-        request = ElementSOAP.SoapRequest(action)
+        return self.get_entry_result(self.call('get_entry',
+                self.get_entry_request(session_id, module, id, select_fields)))
+
+    def get_entry_request(self, session_id, module, id, select_fields):
+        request = ElementSOAP.SoapRequest('get_entry')
         ElementSOAP.SoapElement(request, "session", "string", session_id)
         ElementSOAP.SoapElement(request, "module", "string", module)
         ElementSOAP.SoapElement(request, "id", "string", id)
-        ElementSOAP.SoapElement(request, "selection", "list", select_fields)
+        add_selection(request, "selection", "list", select_fields)
+        return request
 
-        response = self.call(action, request)
+    def get_entry_result(self, response):
         ret = response.find('return')
         entry_list = ret.find('entry_list')
 
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         item = entry_list.find('item')
 
         return name_value_to_item(item)
 
+    def get_entries(self, session_id, module, ids, select_fields):
+        '''
+        same as get_entry but for a list of ids, all the entries are
+        fetched with a single call.
+        Returns a list of items, ids unknown to the server are left out.
+
+        In case of error this module will raise a SugarError exception
+        '''
+        action = 'get_entries'
+        request = ElementSOAP.SoapRequest(action)
+        ElementSOAP.SoapElement(request, "session", "string", session_id)
+        ElementSOAP.SoapElement(request, "module", "string", module)
+        ids_el = ElementSOAP.SoapElement(request, "ids", "Array")
+        for id in ids:
+            ElementSOAP.SoapElement(ids_el, 'item', 'string', id)
+        add_selection(request, "selection", "list", select_fields)
+
+        response = self.call(action, request)
+        ret = response.find('return')
+
+        error_elem = ret.find('error')
+        check_error(error_elem)
+
+        elist = []
+        for entry in ret.find('entry_list').findall('item'):
+            elist.append(name_value_to_item(entry))
+
+        return elist
+
+    def get_entry_list_request(self, session_id, module, query, order_by,
+                offset, selection, max_result, deleted):
+        '''
+        builds the get_entry_list request shared by get_entry_list
+        and stream_entry_list
+        '''
+        request = ElementSOAP.SoapRequest('get_entry_list')
+        ElementSOAP.SoapElement(request, "session", "string", session_id)
+        ElementSOAP.SoapElement(request, "module", "string", module)
+        ElementSOAP.SoapElement(request, "query", "string", query)
+        ElementSOAP.SoapElement(request, "order_by", "string", order_by)
+        ElementSOAP.SoapElement(request, "offset", "integer", offset)
+        add_selection(request, "select_fields", "string", selection)
+        ElementSOAP.SoapElement(request, "max_results", "integer", max_result)
+        ElementSOAP.SoapElement(request, "deleted", "integer", deleted)
+        return request
+
     def get_entry_list(self, session_id, module, query, order_by,
                 offset, selection, max_result, deleted):
         '''
         Get a list of entries for a specified module in essence the same
         as a get_entry call where the result will be a list of items
         instead of just one.
+        The returned SugarEntryList also carries the result_count and
+        next_offset sent by the server.
         query must be of the form:
         "leads.last_name LIKE 'T%'"
         or
@@ -324,39 +636,48 @@ class SugarService(ElementSOAP.SoapService):
         '''
        
         action = 'get_entry_list'
-        request = ElementSOAP.SoapRequest(action)
-        ElementSOAP.SoapElement(request, "session", "string", session_id)
-        ElementSOAP.SoapElement(request, "module", "string", module)
-        ElementSOAP.SoapElement(request, "query", "string", query)
-        ElementSOAP.SoapElement(request, "order_by", "string", order_by)
-        ElementSOAP.SoapElement(request, "offset", "integer", offset)
-        ElementSOAP.SoapElement(request, "select_fields", "string", selection)
-        ElementSOAP.SoapElement(request, "max_results", "integer", max_result)
-        ElementSOAP.SoapElement(request, "deleted", "integer", deleted)
-       
-        print query
-        print action
-       
-        response = self.call(action, request)
-        
+        request = self.get_entry_list_request(session_id, module, query,
+                order_by, offset, selection, max_result, deleted)
+
+        return self.get_entry_list_result(self.call(action, request))
+
+    def get_entry_list_result(self, response):
         ret = response.find('return')
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-       
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         entries = ret.find('entry_list').findall('item')
-        elist = []
+        elist = SugarEntryList()
         for entry in entries:
             elist.append(name_value_to_item(entry))
 
-        # TODO: we should also return the next offset and friends...
+        if ret.findtext('result_count'):
+            elist.result_count = int(ret.findtext('result_count'))
+        if ret.findtext('next_offset'):
+            elist.next_offset = int(ret.findtext('next_offset'))
+        # only sent by some server versions
+        if ret.findtext('total_count'):
+            elist.total_count = int(ret.findtext('total_count'))
+
         return elist
 
+    def stream_entry_list(self, session_id, module, query, order_by,
+                offset, selection, max_result, deleted,
+                decode=name_value_to_item):
+        '''
+        same arguments as get_entry_list but returns a
+        SugarEntryListStream that yields the entries one at a time
+        while the response is being received, instead of building
+        the whole list in memory first.
+        decode is called with each entry element and its result is
+        what the stream yields.
+        '''
+        action = 'get_entry_list'
+        request = self.get_entry_list_request(session_id, module, query,
+                order_by, offset, selection, max_result, deleted)
+
+        return SugarEntryListStream(self._send(action, request), decode)
+
     def get_available_modules(self, session_id):
         '''
         returns the list of modules names (strings)
@@ -369,13 +690,7 @@ class SugarService(ElementSOAP.SoapService):
         response = self.call(action, request)
         ret = response.find('return')
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         modules_el = ret.find('modules')
         modules_list = []
@@ -399,13 +714,7 @@ class SugarService(ElementSOAP.SoapService):
         response = self.call(action, request)
         ret = response.find('return')
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         note_attachm = ret.find('note_attachment')
         filename = note_attachm.findtext('filename')
@@ -491,12 +800,18 @@ class SugarService(ElementSOAP.SoapService):
         about this you should direct your questions to the Sugar CRM team.
 
         '''
+        return self.get_relationships_result(self.call('get_relationships',
+                self.get_relationships_request(session_id, module_name,
+                    module_id, related_module, related_module_query,
+                    deleted)))
+
+    def get_relationships_request(self, session_id, module_name, module_id,
+            related_module, related_module_query, deleted=False):
         if not isinstance(deleted, types.BooleanType):
             msg='deleted keyword must be an integer, not: %s' % type(deleted)
             raise ValueError(msg)
 
-        action = 'get_relationships'
-        request = ElementSOAP.SoapRequest(action)
+        request = ElementSOAP.SoapRequest('get_relationships')
         ElementSOAP.SoapElement(request, "session", "string", session_id)
         ElementSOAP.SoapElement(request, "module_name", "string", module_name)
         ElementSOAP.SoapElement(request, "module_id", "string", module_id)
@@ -505,17 +820,12 @@ class SugarService(ElementSOAP.SoapService):
         ElementSOAP.SoapElement(request, "related_module_query",
                 "string", related_module_query)
         ElementSOAP.SoapElement(request, "deleted", "string", deleted)
+        return request
 
-        response = self.call(action, request)
+    def get_relationships_result(self, response):
         ret = response.find('return')
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         items_el = ret.find('ids')
         id_list = []
@@ -530,25 +840,25 @@ class SugarService(ElementSOAP.SoapService):
         set a relationship beetween module1_id and module2_id
         the same rules apply that are described in get_relationships
         '''
-        action = 'set_relationships'
-        request = ElementSOAP.SoapRequest(action)
+        return self.set_relationship_result(self.call('set_relationships',
+                self.set_relationship_request(session_id, module1,
+                    module1_id, module2, module2_id)))
+
+    def set_relationship_request(self, session_id, module1,
+            module1_id, module2, module2_id):
+        request = ElementSOAP.SoapRequest('set_relationships')
         ElementSOAP.SoapElement(request, "session", "string", session_id)
         srv = ElementSOAP.SoapElement(request, "set_relationship_value")
         ElementSOAP.SoapElement(srv, "module1", "string", module1)
         ElementSOAP.SoapElement(srv, "module1_id", "string", module1_id)
         ElementSOAP.SoapElement(srv, "module2", "string", module2)
         ElementSOAP.SoapElement(srv, "module2_id", "string", module2_id)
+        return request
 
-        response = self.call(action, request)
+    def set_relationship_result(self, response):
         ret = response.find('return')
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         return ret
 
@@ -578,16 +888,99 @@ class SugarService(ElementSOAP.SoapService):
 
         ret = response.find('return')
         error_elem = ret.find('error')
-        error = int(error_elem.findtext('number'))
-
-        if error:
-            name = error_elem.findtext('name')
-            desc = error_elem.findtext('description')
-            raise SugarError('number: %s, name: "%s", desc: "%s"' % (
-                    error, name, desc))
+        check_error(error_elem)
 
         return ret
 
+class SugarSessionStore(object):
+    '''
+    Keeps the session ids of the SugarSession objects in a local file,
+    so that a restarted process, or another process on the same host,
+    can reuse a session that is still valid instead of logging in again.
+
+    path: the file holding the session ids. It is created readable by
+    its owner only, since a session id is as good as a password while
+    it is valid. A path + '.lock' file is used to serialize the
+    accesses between processes (where fcntl is available).
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.lock = threading.Lock()
+
+    def _key(self, base_url, username):
+        return '%s|%s' % (base_url, username)
+
+    def _locked(self, fn):
+        self.lock.acquire()
+        try:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                return fn()
+            finally:
+                # closing the file releases the flock
+                os.close(fd)
+        finally:
+            self.lock.release()
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return {}
+        try:
+            try:
+                return json.load(f)
+            except ValueError:
+                # a damaged store only costs a login
+                return {}
+        finally:
+            f.close()
+
+    def _save(self, sessions):
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(sessions, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+    def get(self, base_url, username):
+        '''
+        returns the stored session id for this server and user, or None
+        '''
+        key = self._key(base_url, username)
+        return self._locked(lambda: self._load().get(key))
+
+    def set(self, base_url, username, session_id):
+        key = self._key(base_url, username)
+        def update():
+            sessions = self._load()
+            sessions[key] = session_id
+            self._save(sessions)
+        self._locked(update)
+
+    def delete(self, base_url, username, session_id=None):
+        '''
+        forget the session id of this server and user. When session_id
+        is given, the entry is only removed if it still holds this id,
+        so a session stored in the meantime by another process is kept.
+        '''
+        key = self._key(base_url, username)
+        def update():
+            sessions = self._load()
+            if key not in sessions:
+                return
+            if session_id is not None and sessions[key] != session_id:
+                return
+            del sessions[key]
+            self._save(sessions)
+        self._locked(update)
+
 class SugarSession:
     '''
     This class is the entry point to the rest of the API.
@@ -599,7 +992,10 @@ class SugarSession:
     
     
     def __init__(self, username, password, base_url,
-            debug=True, user_management=False, nusoapfile='soap.php'):
+            debug=True, user_management=False, nusoapfile='soap.php',
+            connection_pool=None, entry_cache=None, query_cache=None,
+            single_flight=True, fast_connect=False, session_store=None,
+            relogin=True, limiter=None):
         '''
         username: a string representing the login
         password: a string with the password for the login
@@ -610,6 +1006,37 @@ class SugarSession:
         nusoapfile: the name of the nusoap file (php script) that will
         be used. This is here so that users can write their own php nusoap
         servers for sugar and connect to it.
+        connection_pool: a sugartransport.SugarConnectionPool to share
+        keep-alive connections with other sessions. By default the
+        session gets a pool of its own.
+        entry_cache: a sugarcache.SugarEntryCache serving get_entry calls
+        from memory. The records written through this session are
+        invalidated. No cache is used by default.
+        query_cache: a sugarcache.SugarQueryCache serving get_entry_list
+        calls from memory. The results for a module are invalidated when
+        this session writes to it. No cache is used by default.
+        single_flight: when True, concurrent identical read calls made
+        from several threads are collapsed into one request, see
+        sugarcache.SugarSingleFlight. self.single_flight.get_stats()
+        tells how many calls were saved. A read of a module made after
+        this session wrote to it never shares a call started before the
+        write.
+        fast_connect: when True, the server is not probed and the login
+        is delayed until the first call that needs a session, so creating
+        the session costs no round trip at all. A bad url or bad
+        credentials are then only reported by that first call.
+        session_store: a SugarSessionStore. The session id obtained at
+        login is saved there and the next SugarSession created for the
+        same server and user reuses it, as long as the server still
+        accepts it.
+        relogin: when True, a call rejected because the server does not
+        know the session id anymore (it expired or the server restarted)
+        logs in again with the same credentials and is retried once.
+        Streamed calls are not retried.
+        limiter: a sugarlimit.SugarConcurrencyLimiter adapting the number
+        of set_entries calls, and of export_entry_list pages, sent at the
+        same time to what the server can take. It can be shared by
+        several sessions talking to the same server.
         
         example:
             s = SugarSession('myuser', 'mypass', 'http://myserver/sugar')
@@ -618,14 +1045,35 @@ class SugarSession:
         '''
         
         self.user_management = user_management
+        self.entry_cache = entry_cache
+        self.query_cache = query_cache
+        if single_flight:
+            self.single_flight = SugarSingleFlight()
+        else:
+            self.single_flight = None
+        # module -> number of the last write made to it through this
+        # session, part of the keys of the shared reads
+        self._written = {}
+        self._writes = itertools.count(1)
         self._session_id = False
         self._debug = debug
+        self.session_store = session_store
+        self._username = username
+        self._password = password
+        self._lazy_login = fast_connect
+        self._login_lock = threading.RLock()
+        self.relogin = relogin
+        self.limiter = limiter
 
         self.base_url = base_url
         self.application_name = 'pysugar'
         #soap_url = base_url + '/soap.php?wsdl'
         user_url = base_url + '/soap_users.php?wsdl'
         soap_url = base_url + "/" + nusoapfile
+
+        if fast_connect:
+            self.service = SugarService(soap_url, connection_pool)
+            return
         
         try:
             urllib2.urlopen(soap_url)
@@ -641,7 +1089,7 @@ class SugarSession:
                 msg += "Maybe you should deploy the soap_users.php script ?"
                 raise SugarConnectError(msg)
 
-        self.service = SugarService(soap_url)
+        self.service = SugarService(soap_url, connection_pool)
         #try:
         #    self.soap_proxy = SOAPpy.WSDL.Proxy(soap_url)
         #
@@ -663,7 +1111,7 @@ class SugarSession:
             msg += "or unresponsive"
             raise SugarError(msg)
         else:
-            self.login(username, password)
+            self._connect()
 
    
 
@@ -679,10 +1127,87 @@ class SugarSession:
         SugarCredentialError exception
         If session is OK this method returns nothing
         '''
+        if not self._session_id and self._lazy_login:
+            self._login_lock.acquire()
+            try:
+                if not self._session_id:
+                    self._connect()
+            finally:
+                self._login_lock.release()
         if not self._session_id:
             raise SugarCredentialError(
                     'A valid session id is required to use this method')
 
+    def _connect(self):
+        '''
+        opens the session with the credentials given to the constructor,
+        reusing the session id of the session store when the server still
+        knows it
+        '''
+        if self.session_store is not None:
+            session_id = self.session_store.get(self.base_url, self._username)
+            if session_id:
+                user_id = self.service.get_user_id(session_id)
+                if user_id and user_id != '-1':
+                    self._session_id = session_id
+                    return
+                self.session_store.delete(self.base_url, self._username,
+                        session_id)
+        self.login(self._username, self._password)
+
+    def _relogin(self, stale_session_id):
+        '''
+        replace a session id the server rejected. Threads that got the
+        same rejection only log in once.
+        '''
+        self._login_lock.acquire()
+        try:
+            if self._session_id != stale_session_id:
+                # another thread did it already
+                return
+            if self.session_store is not None:
+                self.session_store.delete(self.base_url, self._username,
+                        stale_session_id)
+            self.login(self._username, self._password)
+        finally:
+            self._login_lock.release()
+
+    def _call(self, method, *args):
+        '''
+        calls the given service method with the session id followed by
+        args. If the server rejects the session id, logs in again and
+        retries once.
+        '''
+        session_id = self._session_id
+        try:
+            return method(session_id, *args)
+        except SugarInvalidSessionError:
+            if not self.relogin:
+                raise
+            self._relogin(session_id)
+            return method(self._session_id, *args)
+
+    def _shared(self, key, fn):
+        '''
+        calls fn. Calls with the same key made at the same time by other
+        threads share the same request.
+        '''
+        if self.single_flight is None:
+            return fn()
+        return self.single_flight.do(key, fn, copy_result)
+
+    def _read(self, action, *args):
+        '''
+        calls the given read method of the service like _call, sharing
+        the identical calls made at the same time. The first of args,
+        when there is one, is the module read.
+        '''
+        method = getattr(self.service, action)
+        key = (action,) + tuple([selection_key(arg) for arg in args])
+        if args:
+            key += (self._written.get(args[0]),)
+        return self._shared(key, lambda: self._call(method, *args))
+
     def login(self, username, password):
         '''
         tries to log into the Sugar server with the given credentials
@@ -690,8 +1215,12 @@ class SugarSession:
         
         session_id = self.service.login(username, password)
         self._session_id = session_id
+        self._username = username
+        self._password = password
+        if self.session_store is not None:
+            self.session_store.set(self.base_url, username, session_id)
 
-        if self._debug:           
+        if self._debug and not self._lazy_login:
             self.get_user_id()
             
         
@@ -707,10 +1236,15 @@ class SugarSession:
         these things we will use the sugarobjects module.
         '''
         self.__validate_login()
-
-        return self.service.get_entry_list(self._session_id,
-                module, query, order_by, offset,
-                selection, max_result, deleted)
+        def fetch():
+            return self._read('get_entry_list',
+                    module, query, order_by, offset,
+                    selection, max_result, deleted)
+
+        if self.query_cache is None:
+            return fetch()
+        return self.query_cache.get_entry_list(fetch, module, query,
+                order_by, offset, selection, max_result, deleted)
     
         #next_offset = res.next_offset
         #field_list = res.field_list
@@ -725,13 +1259,104 @@ class SugarSession:
 
         #return my_items
 
+    def iter_entry_list(self, module, query='', order_by='', selection='',
+            page_size=sugarpaging.DefaultPageSize, deleted=0, prefetch=True):
+        '''
+        generator over all the entries matching query, following the
+        next_offset sent by the server page after page.
+        With prefetch, the next page is fetched on a background thread
+        while the current one is being consumed:
+
+            for lead in s.iter_entry_list('Leads', "leads.status = 'New'"):
+                print lead['last_name']
+        '''
+        self.__validate_login()
+
+        def fetch(offset, max_result):
+            return self.get_entry_list(module, query, order_by,
+                    offset, selection, max_result, deleted)
+
+        return sugarpaging.iter_entries(fetch, page_size, 0, prefetch)
+
+    def export_entry_list(self, module, query='', order_by='', selection='',
+            page_size=sugarpaging.DefaultPageSize, workers=4,
+            max_in_flight=None, deleted=0, total=None):
+        '''
+        generator over all the entries matching query, like
+        iter_entry_list, but the pages are fetched in parallel by
+        several worker threads and merged back in offset order.
+        max_in_flight bounds the number of pages being fetched or
+        waiting to be consumed.
+
+        Each worker uses its own connection from the connection pool,
+        so the pool should allow at least workers connections per host.
+        order_by should give a stable ordering, otherwise rows may move
+        between pages while they are being fetched.
+
+        With a limiter, workers is the most pages fetched at the same
+        time, the limiter may allow less.
+
+        see sugarpaging.SugarParallelExporter
+        '''
+        self.__validate_login()
+
+        def fetch(offset, max_result):
+            if self.limiter is not None:
+                return self.limiter.run_sized(max_result,
+                        self.get_entry_list, module, query, order_by,
+                        offset, selection, max_result, deleted)
+            return self.get_entry_list(module, query, order_by,
+                    offset, selection, max_result, deleted)
+
+        return iter(sugarpaging.SugarParallelExporter(fetch, page_size,
+                workers, max_in_flight, total))
+
+    def stream_entry_list(self, module, query, order_by,
+            offset, selection, max_result, deleted,
+            decode=name_value_to_item):
+        '''
+        same as get_entry_list but the entries are decoded one at a time
+        while the answer comes in, which keeps the memory footprint of
+        big pages close to the size of one entry:
+
+            stream = s.stream_entry_list('Leads', '', '', 0, '', 1000, 0)
+            with stream:
+                for item in stream:
+                    print item['last_name']
+
+        The stream holds a pooled connection until it is closed, which
+        the with block makes sure of even when the loop stops early.
+
+        decode turns each entry element into the yielded value,
+        see entry_values to write your own.
+        see SugarEntryListStream
+        '''
+        self.__validate_login()
+
+        return self.service.stream_entry_list(self._session_id,
+                module, query, order_by, offset,
+                selection, max_result, deleted, decode)
+
     def get_entry(self, module, id, selection):
         '''
         This method is the way to get entries according to their ids
         '''
         self.__validate_login()
-        return self.service.get_entry(self._session_id, module,
-                id, selection)
+        def fetch():
+            return self._read('get_entry', module,
+                    id, selection)
+
+        if self.entry_cache is None:
+            return fetch()
+        return self.entry_cache.get_entry(fetch, module, id, selection)
+
+    def get_entries(self, module, ids, selection):
+        '''
+        This method fetches several entries by id with one call
+        '''
+        self.__validate_login()
+        return self._read('get_entries', module,
+                ids, selection)
 
     def set_entry(self, module, item):
         '''
@@ -741,15 +1366,37 @@ class SugarSession:
         created/modified entry will be returned
         '''
         self.__validate_login()
-        return self.service.set_entry(self._session_id, module, item)
+        try:
+            return self._call(self.service.set_entry, module, item)
+        finally:
+            self._invalidate(module, [item])
 
     def set_entries(self, module, items):
         '''
         create a batch of new entries in Sugar for the same module
         '''
         self.__validate_login()
-        return self.service.set_entries( self._session_id,
-                module, items)
+        try:
+            if self.limiter is not None:
+                return self.limiter.run_sized(len(items), self._call,
+                        self.service.set_entries, module, items)
+            return self._call(self.service.set_entries, module, items)
+        finally:
+            self._invalidate(module, items)
+
+    def _invalidate(self, module, items):
+        '''
+        drop the cached copies of the items written to module, the
+        reads of module in progress are not shared anymore
+        '''
+        self._written[module] = self._writes.next()
+        if self.query_cache is not None:
+            self.query_cache.invalidate(module)
+        if self.entry_cache is None:
+            return
+        for item in items:
+            if item.get('id'):
+                self.entry_cache.invalidate(module, item['id'])
 
     def set_note_attachment(self, note):
         '''
@@ -764,7 +1411,7 @@ class SugarSession:
         and the binary content of the file attached to the note
         '''
         self.__validate_login()
-        res = self.service.get_note_attachment(self._session_id, id)
+        res = self._call(self.service.get_note_attachment, id)
 
         return res
     
@@ -786,16 +1433,28 @@ class SugarSession:
         '''
         self.__validate_login()
         res = self.service.logout(self._session_id)
+        if self.session_store is not None:
+            self.session_store.delete(self.base_url, self._username,
+                    self._session_id)
         # make sure session id is now invalid
         self._session_id = None
+        # an explicit logout is not undone by the next call
+        self._lazy_login = False
     
+    def get_pool_stats(self):
+        '''
+        returns the counters of the connection pool used by this session
+        see SugarConnectionPool.get_stats
+        '''
+        return self.service.connection_pool.get_stats()
+
     def get_user_id(self):
         '''
         this will return a user id string
         if the session is invalid the returned user id will be '-1'
         '''
         self.__validate_login()
-        return self.service.get_user_id(self._session_id)
+        return self._read('get_user_id')
 
     def get_module_fields(self, module_name):
         self.__validate_login()
@@ -809,7 +1468,7 @@ class SugarSession:
         Lists the modules present on the server we are logged in
         '''
         self.__validate_login()
-        res = self.service.get_available_modules(self._session_id)
+        res = self._read('get_available_modules')
 
         return res
         #error = res.error
@@ -871,7 +1530,7 @@ class SugarSession:
         the timezone IS specified in the intance using the pytz library
         You can use this function without being logged into the server.
         '''
-        res = self.service.get_gmt_time()
+        res = self._shared(('get_gmt_time',), self.service.get_gmt_time)
         utc = timezone('UTC')
 
         (ymd, hms) = res.split(' ')
@@ -1008,8 +1667,7 @@ class SugarSession:
         about this you should direct your questions to the Sugar CRM team.
         '''
         self.__validate_login()
-        return self.service.get_relationships(
-               self._session_id,
+        return self._read('get_relationships',
                module_name,
                module_id,
                related_module,
@@ -1019,9 +1677,12 @@ class SugarSession:
 
     def set_relationship(self, module1, module1_id, module2, module2_id):
         self.__validate_login()
-        return self.service.set_relationship(
-                self._session_id, module1, module1_id,
-                module2, module2_id)
+        try:
+            return self._call(self.service.set_relationship,
+                    module1, module1_id, module2, module2_id)
+        finally:
+            self._invalidate(module1, [{'id': module1_id}])
+            self._invalidate(module2, [{'id': module2_id}])
             
     def set_relationships(self, set_relationship_list):
         '''
@@ -1042,7 +1703,6 @@ class SugarSession:
         in the install directory or the pysugar distribution.
         '''
         self.__validate_login()
-        return self.service.prune_meetings(
-            self._session_id, date_from, date_to)
+        return self._call(self.service.prune_meetings, date_from, date_to)
 
 # vim: expandtab tabstop=4 shiftwidth=4:
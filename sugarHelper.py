@@ -1,3 +1,4 @@
+import time
 from pysugar import *
 from django.conf import settings
 
@@ -8,6 +9,16 @@ class SugarSingleton :
 
     instance = None
 
+    # The session is checked at most once every check_interval seconds,
+    # None means settings.SUGAR_CHECK_INTERVAL (read on each call, the
+    # settings may not be configured yet when this module is imported).
+    # In between, a session the server dropped is renewed by the
+    # SugarSession itself on the first call it rejects, see the relogin
+    # argument of SugarSession.
+
+    check_interval = None
+    checked_at = 0
+
     # Define a helper class that will override the __call___
     # method in order to provide a factory method for SugarSingleton.
 
@@ -31,16 +42,24 @@ class SugarSingleton :
                 return settings.SUGAR_DEV_URL
             else:
                 return settings.SUGAR_PROD_URL
+
+        def check_interval(self):
+            if SugarSingleton.check_interval is not None:
+                return SugarSingleton.check_interval
+            return getattr(settings, 'SUGAR_CHECK_INTERVAL', 300)
         
 
+        def new_session(self):
+            SugarSingleton.instance = SugarSession(self.sugar_username(), self.sugar_password(), self.sugar_url(),'TRUE')
+            SugarSingleton.checked_at = time.time()
+
         def __call__( self, *args, **kw ) :
 
             # If an instance of SugarSingleton does not exist,
             # create one and assign it to SugarSingleton.instance.
             
             if SugarSingleton.instance is None :
-                object  = SugarSession(self.sugar_username(), self.sugar_password(), self.sugar_url(),'TRUE')
-                SugarSingleton.instance = object
+                self.new_session()
                
                 
             # Return SugarSingleton.instance, which should contain
@@ -48,18 +67,20 @@ class SugarSingleton :
             # in the system.
             
             #Test to see if a connection is working and operational, if not create a new session.
-            try:
-                print SugarSingleton.instance.get_gmt_time()
-            except pysugar.SugarError:
-                SugarSingleton.instance = SugarSession(self.sugar_username(), self.sugar_password(), self.sugar_url(),'TRUE')
+            elif time.time() - SugarSingleton.checked_at >= self.check_interval() :
+                self.test_connection()
             
             return SugarSingleton.instance
         
         def test_connection( self, *args, **kw ) :
+            # get_user_id answers '-1' instead of an error when the
+            # session id is no longer valid
             try:
-                print SugarSingleton.instance.get_gmt_time()
-            except pysugar.SugarError:
-                SugarSingleton.instance = SugarSession(self.sugar_username(), self.sugar_password(), self.sugar_url(),'TRUE')
+                if SugarSingleton.instance.get_user_id() == '-1':
+                    SugarSingleton.instance.login(self.sugar_username(), self.sugar_password())
+                SugarSingleton.checked_at = time.time()
+            except SugarError:
+                self.new_session()
 
     # Create a class level method that must be called to
     # get the single instance of SugarSingleton.
@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Client side caches for the pysugar library
+#
+import copy
+import cPickle
+import hashlib
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+DefaultMaxEntries = 1000
+DefaultTTL = 30
+DefaultMaxBytes = 16 * 1024 * 1024
+# generations must outlive the results they index
+GenerationTTL = 30 * 24 * 3600
+# how long SugarDjangoCache trusts the generation it read
+GenerationCheckInterval = 5
+
+def selection_key(selection):
+    '''
+    a hashable version of a fields selection
+    '''
+    if isinstance(selection, (list, tuple)):
+        return tuple(sorted(selection))
+    return selection
+
+def entries_size(entries):
+    '''
+    a rough estimate of the memory used by a list of items, in bytes
+    '''
+    size = 0
+    for item in entries:
+        for key, value in item.iteritems():
+            size += len(key or '') + len(value or '')
+    return size
+
+def copy_result(result):
+    '''
+    copy a call result so that it can be handed to another caller, or
+    kept in a cache, without being altered by the other users. Lists
+    keep their class and attributes (such as SugarEntryList).
+    '''
+    if isinstance(result, list):
+        result = copy.copy(result)
+        result[:] = [copy_result(item) for item in result]
+    elif isinstance(result, dict):
+        result = dict(result)
+    return result
+
+class SugarSingleFlight(object):
+    '''
+    Collapses concurrent calls sharing the same key into one: the first
+    caller runs the function, the others wait for its result (or its
+    exception). saved counts the calls that did not have to be made.
+    Only use it for calls without side effects.
+    '''
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.made = 0
+        self.saved = 0
+
+    def do(self, key, fn, share=None):
+        '''
+        returns fn(), or the result of the identical call in progress.
+        share, when given, is applied to the result handed to the
+        waiting callers, for instance to give each of them a copy.
+        '''
+        self.lock.acquire()
+        call = self.calls.get(key)
+        if call is not None:
+            self.saved += 1
+            self.lock.release()
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            if share is not None:
+                return share(call.result)
+            return call.result
+
+        call = self.Call()
+        self.calls[key] = call
+        self.made += 1
+        self.lock.release()
+        try:
+            call.result = fn()
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call.done.set()
+        return call.result
+
+    def get_stats(self):
+        return {'calls': self.made, 'saved': self.saved}
+
+def cache_key(key, prefix='pysugar'):
+    '''
+    turns a cache key tuple into a string suitable for shared backends
+    '''
+    return '%s:%s' % (prefix, hashlib.md5(repr(key)).hexdigest())
+
+class SugarCacheBackend(object):
+    '''
+    The interface of the storages used by SugarEntryCache and
+    SugarQueryCache. Keys are tuples, values are picklable objects.
+    Backends shared between processes let several workers use the
+    results fetched by any of them.
+    '''
+    def get(self, key):
+        '''
+        returns the value for key, or None when it is not cached
+        or has expired
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None, size=1):
+        '''
+        store value for ttl seconds, size is the estimated size of value
+        for backends bounded in bytes
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_stats(self):
+        return {}
+
+class SugarLRUCache(SugarCacheBackend):
+    '''
+    A thread safe least recently used cache whose entries expire
+    after a time to live. This is the in process backend.
+
+    max_entries: the maximum number of entries, None for no limit
+    max_bytes: the maximum total size of the entries, None for no limit.
+        The size of each entry is given when it is set.
+    ttl: the default time to live of the entries in seconds
+    '''
+    def __init__(self, max_entries=DefaultMaxEntries, max_bytes=None,
+            ttl=DefaultTTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (value, expiration time, size)
+        self.data = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        value, expires, size = self.data.pop(key)
+        self.bytes -= size
+
+    def _evict(self):
+        while self.data and (
+                (self.max_entries is not None
+                    and len(self.data) > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            key, (value, expires, size) = self.data.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def get(self, key):
+        '''
+        returns the value for key, or None when it is not cached
+        or has expired
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, size = entry
+            if expires < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # most recently used entries go to the end
+            del self.data[key]
+            self.data[key] = entry
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, ttl=None, size=1):
+        if ttl is None:
+            ttl = self.ttl
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                self._remove(key)
+            self.data[key] = (value, time.time() + ttl, size)
+            self.bytes += size
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                self._remove(key)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'expirations': self.expirations,
+                    'evictions': self.evictions,
+                    'entries': len(self.data),
+                    'bytes': self.bytes,
+                    }
+        finally:
+            self.lock.release()
+
+class SugarEntryCache(object):
+    '''
+    Read-through cache for SugarSession.get_entry.
+
+    The entries are cached by (module, id, selection) for ttl seconds,
+    at most max_entries records are kept. The session invalidates the
+    records it writes through set_entry, set_entries and
+    set_relationship.
+    backend: a SugarCacheBackend to store the records in, such as a
+    SugarSQLiteCache or SugarDjangoCache shared by several processes.
+    By default the records are kept in memory.
+
+    get_stats() reports the hit rate and an estimate of the time
+    saved, based on the average duration of the calls that missed.
+    '''
+    def __init__(self, max_entries=DefaultMaxEntries, ttl=DefaultTTL,
+            backend=None):
+        # (module, id) -> {selection: (expiry time, item)}, so that a
+        # record is invalidated for all the selections at once. Each
+        # selection keeps its own expiry, storing a new one in the
+        # record does not extend the life of the others.
+        if backend is None:
+            backend = SugarLRUCache(max_entries, ttl=ttl)
+        self.cache = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # bumped by each invalidation, a fetch that overlapped an
+        # invalidation must not store its possibly stale result
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.fetch_time = 0.0
+        self.saved_time = 0.0
+
+    def get_entry(self, fetch, module, id, selection):
+        '''
+        returns the cached item for (module, id, selection) or calls
+        fetch() to get it and caches the result
+        '''
+        key = (module, id)
+        skey = selection_key(selection)
+        record = self.cache.get(key)
+        if record is not None and skey in record:
+            expires, item = record[skey]
+            if expires > time.time():
+                self.lock.acquire()
+                try:
+                    self.hits += 1
+                    if self.misses:
+                        self.saved_time += self.fetch_time / self.misses
+                finally:
+                    self.lock.release()
+                return dict(item)
+
+        generation = self.generation
+        start = time.time()
+        item = fetch()
+        elapsed = time.time() - start
+
+        self.lock.acquire()
+        try:
+            self.misses += 1
+            self.fetch_time += elapsed
+            if generation == self.generation:
+                now = time.time()
+                record = {}
+                for other, value in (self.cache.get(key) or {}).items():
+                    if value[0] > now:
+                        record[other] = value
+                record[skey] = (now + self.ttl, dict(item))
+                self.cache.set(key, record, self.ttl)
+        finally:
+            self.lock.release()
+        return item
+
+    def invalidate(self, module, id):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.cache.delete((module, id))
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.cache.clear()
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            total = self.hits + self.misses
+            if total:
+                hit_rate = float(self.hits) / total
+            else:
+                hit_rate = 0.0
+            stats = {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': hit_rate,
+                    'saved_time': self.saved_time,
+                    }
+        finally:
+            self.lock.release()
+        stats['entries'] = self.cache.get_stats().get('entries')
+        return stats
+
+class SugarQueryCache(object):
+    '''
+    Cache for the results of SugarSession.get_entry_list, keyed on all
+    the arguments of the call.
+
+    ttl: the default time to live of the results in seconds
+    ttls: a dictionnary of per module times to live, such as
+        {'Users': 600}
+    max_bytes: the results are evicted, least recently used first,
+        when their estimated total size goes beyond this
+    backend: a SugarCacheBackend to store the results in, when several
+        processes should share them. max_bytes is then up to the backend.
+
+    Writing to a module through the session invalidates all the cached
+    results of that module. Concurrent identical calls that miss the
+    cache are collapsed into one call to the server.
+    '''
+    def __init__(self, ttl=DefaultTTL, ttls=None, max_bytes=DefaultMaxBytes,
+            backend=None):
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        if backend is None:
+            backend = SugarLRUCache(None, max_bytes, ttl)
+        self.cache = backend
+        self.single_flight = SugarSingleFlight()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _generation(self, module):
+        '''
+        the current generation of module. It is part of the keys so that
+        invalidating a module makes all its results unreachable at once.
+        Generations are random tokens stored in the backend so that an
+        evicted generation never brings old results back.
+        '''
+        key = ('generation', module)
+        generation = self.cache.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.cache.set(key, generation, GenerationTTL)
+        return generation
+
+    def get_entry_list(self, fetch, module, query, order_by, offset,
+            selection, max_result, deleted):
+        '''
+        returns the cached result for these arguments or calls fetch()
+        to get it and caches it
+        '''
+        key = (module, self._generation(module), query, order_by,
+                offset, selection_key(selection), max_result, deleted)
+        result = self.cache.get(key)
+        self.lock.acquire()
+        try:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+        if result is not None:
+            return copy_result(result)
+
+        def load():
+            result = fetch()
+            self.cache.set(key, copy_result(result),
+                    self.ttls.get(module, self.ttl), entries_size(result))
+            return result
+
+        return copy_result(self.single_flight.do(key, load))
+
+    def invalidate(self, module):
+        self.cache.set(('generation', module), uuid.uuid4().hex,
+                GenerationTTL)
+
+    def clear(self):
+        self.cache.clear()
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        self.lock.acquire()
+        try:
+            stats['hits'] = self.hits
+            stats['misses'] = self.misses
+        finally:
+            self.lock.release()
+        stats['collapsed'] = self.single_flight.saved
+        return stats
+
+class SugarSQLiteCache(SugarCacheBackend):
+    '''
+    A backend storing the values in an SQLite database file, so that
+    the worker processes of a server running on the same host share
+    their cache.
+
+    path: the database file, created when missing
+    ttl: the default time to live of the values in seconds
+
+    The values are pickled, and unpickling runs whatever code the data
+    asks for: the file must only be writable by the users running the
+    application, never put it in a shared or world writable directory.
+    '''
+    # expired values are purged every purge_interval writes
+    purge_interval = 1000
+
+    def __init__(self, path, ttl=DefaultTTL, timeout=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.local = threading.local()
+        self.writes = 0
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS pysugar_cache ('
+                'key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+        conn.commit()
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute('SELECT value, expires FROM pysugar_cache '
+                'WHERE key = ?', (cache_key(key),)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return cPickle.loads(str(row[0]))
+
+    def set(self, key, value, ttl=None, size=1):
+        if ttl is None:
+            ttl = self.ttl
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO pysugar_cache '
+                'VALUES (?, ?, ?)', (cache_key(key),
+                sqlite3.Binary(cPickle.dumps(value, 2)), time.time() + ttl))
+        self.writes += 1
+        if self.writes % self.purge_interval == 0:
+            conn.execute('DELETE FROM pysugar_cache WHERE expires < ?',
+                    (time.time(),))
+        conn.commit()
+
+    def delete(self, key):
+        conn = self._connection()
+        conn.execute('DELETE FROM pysugar_cache WHERE key = ?',
+                (cache_key(key),))
+        conn.commit()
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM pysugar_cache')
+        conn.commit()
+
+    def get_stats(self):
+        conn = self._connection()
+        count = conn.execute('SELECT COUNT(*) FROM pysugar_cache').fetchone()
+        return {'entries': count[0]}
+
+class SugarDjangoCache(SugarCacheBackend):
+    '''
+    A backend using the Django cache framework, so that the caches are
+    shared by all the processes using the same Django cache (memcached,
+    redis, database...).
+
+    alias: the name of the cache in the CACHES setting. Defaults to the
+        SUGAR_CACHE setting, or 'default'.
+
+    The keys hold a generation token stored in the Django cache, clear()
+    replaces it so that all the values stored so far become unreachable
+    without touching the other data of the Django cache. They then
+    expire on their own. The token is read again every
+    generation_interval seconds only, so a clear() made by another
+    process takes up to that long to be seen here.
+    '''
+    def __init__(self, alias=None, prefix='pysugar', ttl=DefaultTTL,
+            generation_interval=GenerationCheckInterval):
+        from django.conf import settings
+        from django.core import cache as django_cache
+
+        if alias is None:
+            alias = getattr(settings, 'SUGAR_CACHE', 'default')
+        if hasattr(django_cache, 'caches'):
+            self.cache = django_cache.caches[alias]
+        else:
+            # Django < 1.7
+            self.cache = django_cache.get_cache(alias)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.generation_interval = generation_interval
+        self.generation_key = '%s:generation' % prefix
+        self.generation = None
+        self.generation_checked = 0
+
+    def _generation(self):
+        now = time.time()
+        if self.generation is None or \
+                now - self.generation_checked >= self.generation_interval:
+            generation = self.cache.get(self.generation_key)
+            if generation is None:
+                # add does nothing if another process set it meanwhile
+                self.cache.add(self.generation_key, uuid.uuid4().hex, None)
+                generation = self.cache.get(self.generation_key)
+            self.generation = generation
+            self.generation_checked = now
+        return self.generation
+
+    def _key(self, key):
+        return cache_key(key, '%s:%s' % (self.prefix, self._generation()))
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value, ttl=None, size=1):
+        if ttl is None:
+            ttl = self.ttl
+        self.cache.set(self._key(key), value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
+
+    def clear(self):
+        # the Django cache may hold other data than ours, so it is not
+        # cleared, our keys are moved to a new generation instead
+        generation = uuid.uuid4().hex
+        self.cache.set(self.generation_key, generation, None)
+        self.generation = generation
+        self.generation_checked = time.time()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
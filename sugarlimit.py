@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Adaptive concurrency limit and batch sizes for the bulk calls of the
+# pysugar library
+#
+import httplib
+import threading
+import time
+from contextlib import contextmanager
+from xml.parsers.expat import ExpatError
+from pysugar import SugarConnectError, SugarDataError
+from sugartransport import SugarTransportError
+
+# the errors telling that the server is overloaded, as opposed to the
+# errors about the request itself
+OverloadErrors = (SugarConnectError, SugarTransportError, EnvironmentError,
+        httplib.HTTPException)
+
+# the errors after which a smaller batch may go through: the overload
+# errors, and the answers that are not SOAP, like the page of a PHP
+# fatal error when the server runs out of memory or time
+BatchErrors = OverloadErrors + (ExpatError, SugarDataError)
+
+DefaultBatchSize = 1000
+DefaultMaxBytes = 1024 * 1024
+# the bytes added by the SOAP encoding of each name/value pair
+FieldOverhead = 100
+# the shortest duration taken into account, in seconds
+MinElapsed = 0.001
+
+def item_latency(elapsed, count):
+    '''
+    the time a call handling count items took per item, the measure
+    both the limiter and the batch sizer adapt to
+    '''
+    return max(elapsed, MinElapsed) / max(count, 1)
+
+def size_class(count):
+    '''
+    calls are only compared with calls of the same size class: sizes
+    within a factor of two of each other
+    '''
+    return max(count, 1).bit_length()
+
+class SugarConcurrencyLimiter(object):
+    '''
+    Limits the number of calls running at the same time, and adapts
+    that limit to what the server can take (additive increase,
+    multiplicative decrease):
+
+    - each time limit calls in a row come back in time, the limit
+      grows by increase
+    - a call that fails with one of the overload_errors, or that takes
+      more than tolerance times the fastest call seen (or more than
+      latency_target seconds per item when given), multiplies the
+      limit by decrease. Calls that were already running then are not
+      counted again, so one slowdown only cuts the limit once.
+
+    The calls handling several items (a set_entries batch, a page of
+    get_entry_list) give their size: their latency is then measured
+    per item, and only compared with the calls of about the same size,
+    so that big batches do not look slow next to small ones. Only the
+    calls that succeed are measured, a fast error says nothing about
+    the server load.
+
+    Several threads share a limiter, each call is wrapped with run(),
+    or run_sized() for the calls handling several items:
+
+        limiter = SugarConcurrencyLimiter(max_limit=8)
+        ids = limiter.run_sized(len(items), session.set_entries,
+                'Leads', items)
+
+    or given to a SugarSession, whose set_entries and export_entry_list
+    calls then go through it.
+    get_stats() tells the current limit and the observed latency per
+    item.
+    '''
+    # weight of the last call in the average latency
+    smoothing = 0.2
+
+    def __init__(self, initial=2, min_limit=1, max_limit=16, increase=1,
+            decrease=0.5, tolerance=2.0, latency_target=None,
+            overload_errors=OverloadErrors):
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.latency_target = latency_target
+        self.overload_errors = overload_errors
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0
+        # average latency per item, and the lowest one of each size class
+        self.latency = None
+        self.min_latency = {}
+        self.stats = {
+                'calls': 0,
+                'errors': 0,
+                'waits': 0,
+                'increases': 0,
+                'decreases': 0,
+                }
+
+    def acquire(self):
+        '''
+        waits for a free slot, returns the start time to give back
+        to release
+        '''
+        self.cond.acquire()
+        try:
+            if self.in_flight >= int(self.limit):
+                self.stats['waits'] += 1
+                while self.in_flight >= int(self.limit):
+                    self.cond.wait()
+            self.in_flight += 1
+            self.stats['calls'] += 1
+            return time.time()
+        finally:
+            self.cond.release()
+
+    def _slow(self, latency, size):
+        if self.latency_target is not None:
+            return latency > self.latency_target
+        min_latency = self.min_latency.get(size_class(size))
+        return min_latency is not None \
+                and latency > self.tolerance * min_latency
+
+    def _decrease(self, now):
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self.successes = 0
+        self.last_decrease = now
+        self.stats['decreases'] += 1
+
+    def release(self, start, overloaded=False, size=1, failed=False):
+        '''
+        frees the slot taken at start and adapts the limit. overloaded
+        tells that the call failed because of the server load, failed
+        that it failed for another reason. size is the number of items
+        the call handled.
+        '''
+        now = time.time()
+        latency = item_latency(now - start, size)
+        self.cond.acquire()
+        try:
+            self.in_flight -= 1
+            if overloaded:
+                self.stats['errors'] += 1
+                if start >= self.last_decrease:
+                    self._decrease(now)
+            elif not failed:
+                if self._slow(latency, size):
+                    if start >= self.last_decrease:
+                        self._decrease(now)
+                else:
+                    self.successes += 1
+                    if self.successes >= int(self.limit) \
+                            and self.limit < self.max_limit:
+                        self.limit = min(self.max_limit,
+                                self.limit + self.increase)
+                        self.successes = 0
+                        self.stats['increases'] += 1
+
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.smoothing * (latency - self.latency)
+                key = size_class(size)
+                if latency < self.min_latency.get(key, latency + 1):
+                    self.min_latency[key] = latency
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    @contextmanager
+    def slot(self, size=1):
+        '''
+        holds a slot for the duration of a with block handling size
+        items
+        '''
+        start = self.acquire()
+        try:
+            yield
+        except self.overload_errors:
+            self.release(start, True, size)
+            raise
+        except:
+            self.release(start, size=size, failed=True)
+            raise
+        self.release(start, size=size)
+
+    def run(self, fn, *args, **kw):
+        '''
+        calls fn(*args, **kw) within a slot and returns its result
+        '''
+        return self.run_sized(1, fn, *args, **kw)
+
+    def run_sized(self, size, fn, *args, **kw):
+        '''
+        same as run, for a call handling size items
+        '''
+        start = self.acquire()
+        try:
+            result = fn(*args, **kw)
+        except self.overload_errors:
+            self.release(start, True, size)
+            raise
+        except:
+            self.release(start, size=size, failed=True)
+            raise
+        self.release(start, size=size)
+        return result
+
+    def get_stats(self):
+        '''
+        returns a dictionnary with the current limit, the number of
+        calls running, the average and lowest latency per item (in
+        seconds) and the counters of calls, overload errors, waits and
+        limit changes
+        '''
+        self.cond.acquire()
+        try:
+            stats = dict(self.stats)
+            stats['limit'] = int(self.limit)
+            stats['in_flight'] = self.in_flight
+            stats['latency'] = self.latency
+            stats['min_latency'] = min(self.min_latency.values() or [None])
+        finally:
+            self.cond.release()
+        return stats
+
+class SugarBatchSizer(object):
+    '''
+    Chooses the size of the set_entries batches of a module:
+
+    - a batch holds at most size items, and stops earlier when its
+      encoded size would go over max_bytes
+    - size is tuned by hill climbing on the throughput (items per
+      second) of the batches: after each window of batches, the size
+      keeps moving the same way (times or divided by growth) while the
+      throughput improves, and turns back when it drops
+    - a batch failing with one of the batch_errors (a timeout, an
+      overloaded or out of memory server) shrinks size to shrink times
+      the batch size, and the batch is split in two and sent again.
+      A failed batch holding new members is only sent again with
+      retry_new: the server may have created some of them before
+      failing, retrying would create them twice.
+
+    Give each module its own sizer, see SugarModule.batch_sizer.
+    get_stats() tells the current and best sizes and throughput.
+    '''
+    # the number of batches compared at each size
+    window = 3
+
+    def __init__(self, initial=100, min_size=1, max_size=DefaultBatchSize,
+            max_bytes=DefaultMaxBytes, growth=1.5, shrink=0.5,
+            retry_new=False, batch_errors=BatchErrors):
+        self.size = max(min_size, min(initial, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.growth = growth
+        self.shrink = shrink
+        self.retry_new = retry_new
+        self.batch_errors = batch_errors
+
+        self.lock = threading.Lock()
+        self.direction = 1
+        self.samples = []
+        self.last_rate = None
+        self.best_rate = None
+        self.best_size = None
+        self.stats = {
+                'batches': 0,
+                'items': 0,
+                'failures': 0,
+                'retries': 0,
+                }
+
+    def item_size(self, item):
+        '''
+        the approximate size of an item once encoded in a request
+        '''
+        size = 0
+        for key, value in item.iteritems():
+            if not isinstance(value, basestring):
+                value = str(value)
+            size += len(key) + len(value) + FieldOverhead
+        return size
+
+    def full(self, count, nbytes, item_size):
+        '''
+        tells if a batch of count items and nbytes cannot take an item
+        of item_size more
+        '''
+        return count >= self.size or \
+                (count and nbytes + item_size > self.max_bytes)
+
+    def _resize(self, size):
+        self.size = int(max(self.min_size, min(self.max_size, size)))
+
+    def record(self, count, elapsed):
+        '''
+        a batch of count items went through in elapsed seconds
+        '''
+        self.lock.acquire()
+        try:
+            self.stats['batches'] += 1
+            self.stats['items'] += count
+            # the short batches, like the last one, say little about
+            # the current size
+            if count * 2 < self.size:
+                return
+            # items per second, the inverse of the latency per item
+            # the limiter works with
+            self.samples.append(1.0 / item_latency(elapsed, count))
+            if len(self.samples) < self.window:
+                return
+            rate = sum(self.samples) / len(self.samples)
+            self.samples = []
+            if self.best_rate is None or rate > self.best_rate:
+                self.best_rate = rate
+                self.best_size = self.size
+            if self.last_rate is not None and rate < self.last_rate:
+                self.direction = -self.direction
+            self.last_rate = rate
+            if self.direction > 0:
+                self._resize(self.size * self.growth)
+            else:
+                self._resize(self.size / self.growth)
+        finally:
+            self.lock.release()
+
+    def retry(self, error, batch):
+        '''
+        called when sending batch failed with error. Returns True when
+        the batch should be split and sent again.
+        '''
+        if not isinstance(error, self.batch_errors):
+            return False
+        self.lock.acquire()
+        try:
+            self.stats['failures'] += 1
+            self._resize(len(batch) * self.shrink)
+            # start again from the new size
+            self.samples = []
+            self.last_rate = None
+            self.direction = -1
+            if len(batch) < 2:
+                return False
+            if not self.retry_new and [e for e in batch if e.isnew()]:
+                return False
+            self.stats['retries'] += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        '''
+        returns a dictionnary with the current size, the size with the
+        best throughput seen so far and that throughput (items per
+        second), and the counters of batches, items, failures and retries
+        '''
+        self.lock.acquire()
+        try:
+            stats = dict(self.stats)
+            stats['size'] = self.size
+            stats['max_bytes'] = self.max_bytes
+            stats['best_size'] = self.best_size
+            stats['best_rate'] = self.best_rate
+        finally:
+            self.lock.release()
+        return stats
+
+# vim: expandtab tabstop=4 shiftwidth=4:
@@ -9,11 +9,25 @@
 # Design: Christophe de Vienne, <cdevienne@alphacent.com>
 # Co-design : Florent Aide, <florent.aide@gmail.com>
 
+import sys
+import time
 import types
 import datetime
-from pysugar import SugarDataError, SugarOperationnalError
+import weakref
+import threading
+import itertools
+import Queue
+from collections import OrderedDict
+from elementsoap.ElementSOAP import SoapFault
+from pysugar import SugarDataError, SugarOperationnalError, entry_values, \
+        is_unknown_method
+from sugarpool import SugarPriorityScheduler, Bulk
 
 DefaultBatchSize = 1000
+DefaultFetchSize = 200
+
+# the value of the fields that are not loaded
+NotLoaded = object()
 
 def split_seq(seq, batchsize):
     '''
@@ -29,10 +43,197 @@ def split_seq(seq, batchsize):
         newseq.append(seq[elementcount*batchsize:])
     return newseq
 
+def sql_quote(value):
+    '''
+    quote a value to be used in the WHERE clause sent to the server.
+    Quotes are doubled, which every database Sugar runs on understands.
+    Backslashes are doubled too since MySQL takes them as escapes:
+    elsewhere a value holding one does not match, but cannot end the
+    literal either.
+    '''
+    value = value.replace('\\', '\\\\').replace("'", "''")
+    return "'%s'" % value
+
+class SugarIdentityMap(object):
+    '''
+    The members of a module indexed by id, so that there is only one
+    object per sugar entry.
+
+    capacity: when set, the least recently used members beyond this
+        count are dropped from the map. Modified members are pinned
+        and never dropped until they are posted.
+    weak: members dropped from the map are still found as long as
+        something else refers to them, so an entry never gets two
+        objects. Without a capacity, the map then only holds weak
+        references to the members that are not pinned.
+        Without weak, a dropped member that is fetched again gets a
+        new object.
+
+    The hits, misses and evictions counters are available with
+    get_stats().
+    '''
+    def __init__(self, capacity=None, weak=False, on_evict=None):
+        self.capacity = capacity
+        self.on_evict = on_evict
+        # modified members, never evicted
+        self.pinned = {}
+        # clean members, least recently used first
+        self.lru = OrderedDict()
+        if weak:
+            self.weak = weakref.WeakValueDictionary()
+        else:
+            self.weak = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self):
+        if self.capacity is None:
+            if self.weak is not None:
+                # the clean members are only held by the weak references
+                self.lru.clear()
+            return
+        while len(self.lru) > self.capacity:
+            id, e = self.lru.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None and \
+                    (self.weak is None or id not in self.weak):
+                self.on_evict(id)
+
+    def peek(self, id):
+        '''
+        returns the member for id or None, without touching the
+        counters nor the recently used order
+        '''
+        e = self.pinned.get(id)
+        if e is None:
+            e = self.lru.get(id)
+        if e is None and self.weak is not None:
+            e = self.weak.get(id)
+        return e
+
+    def get(self, id, default=None):
+        e = self.pinned.get(id)
+        if e is None:
+            e = self.lru.pop(id, None)
+            if e is None and self.weak is not None:
+                e = self.weak.get(id)
+            if e is not None:
+                self.lru[id] = e
+                self._evict()
+        if e is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return e
+
+    def __getitem__(self, id):
+        e = self.get(id)
+        if e is None:
+            raise KeyError(id)
+        return e
+
+    def __setitem__(self, id, e):
+        if id in self.pinned:
+            self.pinned[id] = e
+        else:
+            self.lru.pop(id, None)
+            self.lru[id] = e
+        if self.weak is not None:
+            self.weak[id] = e
+        self._evict()
+
+    def __delitem__(self, id):
+        found = self.pinned.pop(id, None) is not None
+        found = self.lru.pop(id, None) is not None or found
+        if self.weak is not None and id in self.weak:
+            del self.weak[id]
+            found = True
+        if not found:
+            raise KeyError(id)
+
+    def __contains__(self, id):
+        return self.peek(id) is not None
+
+    has_key = __contains__
+
+    def pin(self, e):
+        '''
+        keep e in the map whatever the capacity, until unpin is called.
+        When the map holds another object for the same id, e was dropped
+        from it and its entry fetched again: its changes could not be
+        posted, SugarOperationnalError is raised.
+        '''
+        id = e.id
+        if id is None:
+            return
+        other = self.peek(id)
+        if other is not None and other is not e:
+            raise SugarOperationnalError(
+                    'Object %s was dropped from the identity map and '
+                    'fetched again, modify the current one' % id)
+        if id in self.pinned:
+            return
+        self.lru.pop(id, None)
+        self.pinned[id] = e
+
+    def unpin(self, e):
+        '''
+        make e a normal, evictable, member again
+        '''
+        if self.pinned.get(e.id) is e:
+            del self.pinned[e.id]
+            self.lru[e.id] = e
+            self._evict()
+
+    def dirty(self):
+        '''
+        the modified members: a member is pinned when one of its fields
+        is set and unpinned once posted, so there is no need to look
+        at the others
+        '''
+        return self.pinned.values()
+
+    def items(self):
+        if self.weak is not None:
+            return self.weak.items()
+        return self.pinned.items() + self.lru.items()
+
+    def keys(self):
+        return [id for id, e in self.items()]
+
+    def values(self):
+        return [e for id, e in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        if self.weak is not None:
+            return len(self.weak)
+        return len(self.pinned) + len(self.lru)
+
+    def get_stats(self):
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self),
+                'pinned': len(self.pinned),
+                }
+
 class SugarModuleCollection:
-    def __init__(self, backend):
+    '''
+    capacity and weak are given to the identity map of each module,
+    see SugarIdentityMap
+    '''
+    def __init__(self, backend, capacity=None, weak=False):
         self.backend = backend
         self.modules = {}
+        self.capacity = capacity
+        self.weak = weak
+        # cleared when the server turns out not to know get_entries
+        self.use_get_entries = True
 
     def add(self, module_name, module_class):
         self.modules[module_name] = SugarModule(
@@ -44,9 +245,25 @@ class SugarModule(object):
         self.collection = collection
         self.name = name
         self.object_class = object_class
-        self.elements = {}
+        self.elements = SugarIdentityMap(collection.capacity,
+                collection.weak, self._evicted)
         self.new_elements = []
         self.batch_size = DefaultBatchSize
+        # the number of set_entries batches post keeps in flight
+        self.post_concurrency = 1
+        # when set, a sugarlimit.SugarBatchSizer sizes the set_entries
+        # batches instead of batch_size
+        self.batch_sizer = None
+        self.fetch_size = DefaultFetchSize
+        # when set, loading a member also loads up to batch_fault_size
+        # other unloaded members with the same call
+        self.batch_fault_size = 0
+        # ids of the members in elements that are not loaded
+        self.unloaded = set()
+        # when set, members are loaded with only the fields that were
+        # read on the members loaded before
+        self.adaptive_projection = False
+        self.read_fields = set()
 
     def add(self):
         '''
@@ -60,23 +277,188 @@ class SugarModule(object):
         '''
         Fetch a member of this module by id
         '''
-        if not id in self.elements.keys():
+        e = self.elements.get(id)
+        if e is None:
             e = self.object_class(self, id)
             self.elements[id] = e
-        else:
-            e = self.elements[id]
+            self.unloaded.add(id)
         return e
 
-    def get_by(self, expr):
+    def _evicted(self, id):
+        self.unloaded.discard(id)
+
+    def projection(self):
         '''
-        search for the entries matching expr in this module
+        the names of the fields to ask for when loading a member,
+        None means all of them
         '''
-        entry_list = []
-        table_name = self.object_class.table_name
-        # XXX finish this
-        raise NotImplementedError('This method is not yet implemented')
+        if self.adaptive_projection and self.read_fields:
+            return list(self.read_fields)
+        return None
 
-    def post(self, callback = None):
+    def selection(self, names):
+        '''
+        turns a list of field names into the list of properties and the
+        selection to send to the server. None stands for all the fields.
+        '''
+        props = self.object_class.get_properties(names)
+        if names is None:
+            return (props, '')
+        return (props, [prop.field_name for prop in props])
+
+    def get_many(self, ids, prefetch_related=()):
+        '''
+        Fetch several members of this module by id.
+        The members that are not loaded yet are loaded with a few
+        batched calls of fetch_size ids each instead of one get_entry
+        call per member.
+        prefetch_related: names of relation fields whose targets should
+        be loaded as well, see prefetch_related()
+        Returns the members in the order of ids
+        '''
+        elements = [self.get(id) for id in ids]
+
+        to_load = []
+        seen = {}
+        for e in elements:
+            if not e.is_loaded() and e.id not in seen:
+                seen[e.id] = True
+                to_load.append(e.id)
+
+        for chunk in split_seq(to_load, self.fetch_size):
+            self._load_many(chunk)
+
+        if prefetch_related:
+            self.prefetch_related(elements, *prefetch_related)
+
+        return elements
+
+    def prefetch_related(self, elements, *names):
+        '''
+        Load the members related to elements through the given
+        relation fields, with batched calls on each target module
+        instead of one get_entry call per related member:
+
+            leads = store.m.Leads.get_many(ids)
+            store.m.Leads.prefetch_related(leads, 'assigned_user')
+
+        Related members already loaded are not fetched again.
+        '''
+        fields = {}
+        for prop in self.object_class.sugar_properties:
+            fields[prop.name] = prop
+
+        relations = []
+        for name in names:
+            field = fields.get(name)
+            if not isinstance(field, SugarRelationField):
+                raise ValueError('%s is not a relation of the %s module' % (
+                        name, self.name))
+            if field.module not in self.collection.modules:
+                raise ValueError('module %s is not in the collection' % (
+                        field.module))
+            relations.append(field)
+
+        # the foreign ids are values of the elements themselves, new
+        # ones have nothing to prefetch yet
+        elements = [e for e in elements if not e.isnew()]
+        self.get_many([e.id for e in elements if not e.is_loaded()])
+        # members loaded without the relation fields, by a projection
+        lacking = [e.id for e in elements
+                if [field for field in relations if not field.is_loaded(e)]]
+        for chunk in split_seq(lacking, self.fetch_size):
+            self._load_many(chunk, [field.name for field in relations])
+
+        for field in relations:
+            ids = []
+            seen = set()
+            for e in elements:
+                id = field._get_value(e)
+                if id and id not in seen:
+                    seen.add(id)
+                    ids.append(id)
+            self.collection.modules[field.module].get_many(ids)
+
+    def _load_many(self, ids, fields=None):
+        '''
+        load the members with the given ids in one call. fields: the
+        names of the fields to fetch, also loaded in the members that
+        are loaded already but lack them. By default the members not
+        loaded are loaded with the projection of the module.
+        '''
+        backend = self.collection.backend
+        if fields is None:
+            props, selection = self.selection(self.projection())
+        else:
+            props, selection = self.selection(fields)
+        entries = None
+        if self.collection.use_get_entries:
+            try:
+                entries = backend.get_entries(self.name, ids, selection)
+            except SoapFault, e:
+                # older servers do not provide get_entries, any other
+                # fault is a real error
+                if not is_unknown_method(e):
+                    raise
+                self.collection.use_get_entries = False
+
+        if entries is None:
+            query = '%s.id IN (%s)' % (self.object_class.table_name,
+                    ', '.join([sql_quote(id) for id in ids]))
+            entries = backend.get_entry_list(self.name, query, '',
+                    0, selection, len(ids), 0)
+
+        for d in entries:
+            e = self.elements.peek(d['id'])
+            if e is None:
+                continue
+            if not e.is_loaded():
+                e._load_dict(d, props)
+            elif fields is not None:
+                e._load_dict(d, [prop for prop in props
+                        if not prop.is_loaded(e)])
+
+    def _batch_fault(self, element):
+        '''
+        load element along with up to batch_fault_size other
+        unloaded members
+        '''
+        ids = [element.id]
+        gone = []
+        for id in itertools.islice(self.unloaded, self.batch_fault_size + 1):
+            if self.elements.peek(id) is None:
+                # garbage collected from a weak identity map
+                gone.append(id)
+            elif id != element.id and len(ids) <= self.batch_fault_size:
+                ids.append(id)
+        self.unloaded.difference_update(gone)
+        self._load_many(ids)
+
+    def get_by(self, expr=None, **lookups):
+        '''
+        search for the entries matching expr in this module.
+        Returns a lazy SugarQuery, see SugarQuery.filter for the
+        accepted expressions:
+
+            for lead in store.m.Leads.get_by(status='New').limit(10):
+                print lead.last_name
+        '''
+        if expr is None:
+            return SugarQuery(self).filter(**lookups)
+        return SugarQuery(self).filter(expr, **lookups)
+
+    def _hydrate(self, entry):
+        '''
+        decoder for the entries of a streamed get_entry_list: returns
+        the member for the entry, loaded with its values
+        '''
+        id, pairs = entry_values(entry)
+        e = self.get(id)
+        if not e.is_loaded():
+            e._load_pairs(pairs)
+        return e
+
+    def post(self, callback = None, concurrency = None, session_pool = None):
         '''
         take objects from this module in a list and post them
         with a set_entries call...
@@ -92,28 +474,430 @@ class SugarModule(object):
 
         module.post(callback=mycallable)
 
+        concurrency: the number of batches sent at the same time, by
+        default the post_concurrency of the module. The batches are
+        then finalized, and the callback called, as they come back,
+        always from the calling thread.
+        session_pool: a sugarpool.SugarSessionPool (or a
+        SugarPriorityScheduler, the batches then go as Bulk calls)
+        to send each batch with a session of its own instead of the
+        session of the store.
+
+        When a batch fails, no more batches are sent, the ones already
+        sent are finalized and the error is raised. The members of the
+        failed batches are left new or modified and can be posted again.
+        With a batch_sizer, a batch failing because of a timeout or an
+        overloaded server is first split and sent again, see
+        sugarlimit.SugarBatchSizer.
+
         does not return anything
         
         '''
         element_list = []
         element_list.extend(self.new_elements)
-        element_list.extend([e for e in self.elements.values()
+        element_list.extend([e for e in self.elements.dirty()
                                if e.ismodified()])
-
-        for i, batch in enumerate( split_seq(element_list, self.batch_size) ):
-            post_list = [o.get_post_dict() for o in batch]
-        
-            new_ids = self.collection.backend.set_entries(self.name, post_list)
-            for element, new_id in zip(batch, new_ids):
-                element.finalize_post(new_id)
+        batches = self._batches(element_list)
+        # the first two batches tell if there is anything to send
+        # concurrently, the sizer sizes the others as they are built
+        first = list(itertools.islice(batches, 2))
+        batches = itertools.chain(first, batches)
+
+        if session_pool is None:
+            set_entries = self.collection.backend.set_entries
+        elif isinstance(session_pool, SugarPriorityScheduler):
+            def set_entries(module, items):
+                return session_pool.run(Bulk,
+                        lambda session: session.set_entries(module, items))
+        else:
+            def set_entries(module, items):
+                return session_pool.run(
+                        lambda session: session.set_entries(module, items))
+
+        if concurrency is None:
+            concurrency = self.post_concurrency
+        if concurrency > 1 and len(first) > 1:
+            self._post_concurrently(batches, set_entries, concurrency,
+                    callback, len(element_list))
+            return
+
+        posted = 0
+        for batch, post_list in batches:
+            sent, exc_info = self._send_batch(set_entries, batch, post_list)
+            for part, new_ids in sent:
+                self._finalize_batch(part, new_ids)
+                posted += len(part)
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
             if callback is not None:
-                callback(self,
-                    i * self.batch_size + len(batch), len(element_list))
+                callback(self, posted, len(element_list))
+
+    def _batches(self, element_list):
+        '''
+        generator over the (members, post dicts) batches to send. The
+        batch sizer is asked for the size of each batch when it is
+        built, so it follows the size changes made meanwhile.
+        '''
+        sizer = self.batch_sizer
+        if sizer is None:
+            for batch in split_seq(element_list, self.batch_size):
+                yield batch, [o.get_post_dict() for o in batch]
+            return
+
+        batch, post_list, nbytes = [], [], 0
+        for element in element_list:
+            item = element.get_post_dict()
+            size = sizer.item_size(item)
+            if sizer.full(len(batch), nbytes, size):
+                yield batch, post_list
+                batch, post_list, nbytes = [], [], 0
+            batch.append(element)
+            post_list.append(item)
+            nbytes += size
+        if batch:
+            yield batch, post_list
+
+    def _send_batch(self, set_entries, batch, post_list):
+        '''
+        sends a batch, splitting it again when the batch sizer says so.
+        Returns the list of the (members, new ids) that went through and
+        the exc_info of the error that stopped the batch, or None.
+        The members are not touched so this can run on any thread.
+        '''
+        sizer = self.batch_sizer
+        sent = []
+        parts = [(batch, post_list)]
+        while parts:
+            batch, post_list = parts.pop(0)
+            start = time.time()
+            try:
+                new_ids = set_entries(self.name, post_list)
+            except Exception:
+                exc_info = sys.exc_info()
+                if sizer is None or not sizer.retry(exc_info[1], batch):
+                    return sent, exc_info
+                half = (len(batch) + 1) // 2
+                parts[:0] = [(batch[:half], post_list[:half]),
+                        (batch[half:], post_list[half:])]
+                continue
+            if sizer is not None:
+                sizer.record(len(batch), time.time() - start)
+            sent.append((batch, new_ids))
+        return sent, None
+
+    def _finalize_batch(self, batch, new_ids):
+        new_elements = []
+        for element, new_id in zip(batch, new_ids):
+            if element.isnew():
+                new_elements.append(element)
+            element._finalize_post(new_id)
+        if new_elements:
+            # one pass over new_elements instead of one per member
+            posted = set(map(id, new_elements))
+            self.new_elements = [e for e in self.new_elements
+                    if id(e) not in posted]
+
+    def _post_concurrently(self, batches, set_entries, concurrency,
+            callback, total):
+        '''
+        post with up to concurrency batches in flight. The worker
+        threads only make the set_entries calls, the post dicts are
+        built and the members finalized by the calling thread. A worker
+        is only started when all the others are busy, so there are
+        never more workers than batches.
+        '''
+        jobs = Queue.Queue()
+        results = Queue.Queue()
+
+        def work():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                results.put(self._send_batch(set_entries, *job))
+
+        pending = iter(batches)
+        workers = 0
+        in_flight = 0
+        error = None
+        posted = 0
+        try:
+            while True:
+                while error is None and in_flight < concurrency:
+                    job = next(pending, None)
+                    if job is None:
+                        break
+                    if workers == in_flight:
+                        thread = threading.Thread(target=work)
+                        thread.setDaemon(True)
+                        thread.start()
+                        workers += 1
+                    jobs.put(job)
+                    in_flight += 1
+                if not in_flight:
+                    break
+
+                sent, exc_info = results.get()
+                in_flight -= 1
+                for part, new_ids in sent:
+                    self._finalize_batch(part, new_ids)
+                    posted += len(part)
+                if exc_info is not None:
+                    if error is None:
+                        error = exc_info
+                    continue
+                if callback is not None:
+                    callback(self, posted, total)
+        finally:
+            # the batches still in flight when something went wrong in
+            # this thread were sent all the same, finalize them so they
+            # are not posted twice
+            while in_flight:
+                sent, exc_info = results.get()
+                in_flight -= 1
+                for part, new_ids in sent:
+                    self._finalize_batch(part, new_ids)
+            for i in xrange(workers):
+                jobs.put(None)
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+class SugarQuery(object):
+    '''
+    A query on the members of a module. Nothing is sent to the server
+    until the query is iterated over, then the matching members are
+    fetched page after page and loaded directly in the module elements.
+    filter, order_by, limit and prefetch_related return a new query
+    so queries can be built step by step:
+
+        q = store.m.Leads.get_by(status='New')
+        q = q.filter(last_name__like='T%').order_by('-date_entered')
+        for lead in q.limit(100).prefetch_related('assigned_user'):
+            print lead.last_name, lead.assigned_user.user_name
+    '''
+    operators = {
+            'eq': '=',
+            'ne': '<>',
+            'lt': '<',
+            'lte': '<=',
+            'gt': '>',
+            'gte': '>=',
+            'like': 'LIKE',
+            }
+
+    def __init__(self, module):
+        self.module = module
+        self.clauses = []
+        self.ordering = []
+        self.max_count = None
+        self.related = ()
+        self.fields = None
+        self.page_size = module.fetch_size
+
+    def _clone(self):
+        q = SugarQuery(self.module)
+        q.clauses = list(self.clauses)
+        q.ordering = list(self.ordering)
+        q.max_count = self.max_count
+        q.related = self.related
+        q.fields = self.fields
+        q.page_size = self.page_size
+        return q
+
+    def _field(self, name):
+        for prop in self.module.object_class.sugar_properties:
+            if prop.name == name:
+                return prop
+        raise ValueError('%s has no field %s' % (self.module.name, name))
+
+    def _column(self, field):
+        return '%s.%s' % (self.module.object_class.table_name,
+                field.field_name)
+
+    def _sql_value(self, field, value):
+        if isinstance(field, SugarRelationField) \
+                and isinstance(value, SugarObject):
+            value = value.id
+        elif isinstance(value, types.StringTypes):
+            # already in the sugar format, such as '2020-01-01'
+            pass
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat(' ')
+        elif isinstance(value, (datetime.date, datetime.time)):
+            # a date is fine to compare with a datetime field too
+            value = value.isoformat()
+        else:
+            value = field._to_sugar_value(value)
+        if not isinstance(value, types.StringTypes):
+            value = str(value)
+        return sql_quote(value)
+
+    def _compile_lookup(self, lookup, value):
+        if '__' in lookup:
+            name, op = lookup.rsplit('__', 1)
+        else:
+            name, op = lookup, 'eq'
+        field = self._field(name)
+        column = self._column(field)
+
+        if op == 'isnull':
+            if value:
+                return '%s IS NULL' % column
+            return '%s IS NOT NULL' % column
+        elif op == 'in':
+            if not value:
+                return '1 = 0'
+            return '%s IN (%s)' % (column,
+                    ', '.join([self._sql_value(field, v) for v in value]))
+        elif op in self.operators:
+            return '%s %s %s' % (column, self.operators[op],
+                    self._sql_value(field, value))
+        raise ValueError('unknown lookup operator: %s' % op)
+
+    def filter(self, *exprs, **lookups):
+        '''
+        restrict the query. exprs are raw WHERE clause fragments such as
+        "leads.last_name LIKE 'T%'". lookups are field=value pairs where
+        the field name can be suffixed with __ne, __lt, __lte, __gt,
+        __gte, __like, __in or __isnull. The values are either strings
+        in the sugar format ('2020-01-01') or python values of the field
+        type, dates and times being accepted for any field.
+        All the conditions are ANDed.
+        '''
+        q = self._clone()
+        for expr in exprs:
+            q.clauses.append('(%s)' % expr)
+        for lookup, value in sorted(lookups.items()):
+            q.clauses.append(q._compile_lookup(lookup, value))
+        return q
+
+    def order_by(self, *names):
+        '''
+        sort on the given fields, prefix a name with - for a
+        descending order
+        '''
+        q = self._clone()
+        for name in names:
+            if name.startswith('-'):
+                q.ordering.append('%s DESC' % q._column(q._field(name[1:])))
+            else:
+                q.ordering.append(q._column(q._field(name)))
+        return q
+
+    def limit(self, count):
+        q = self._clone()
+        q.max_count = count
+        return q
+
+    def prefetch_related(self, *names):
+        '''
+        load the members related through the given relation fields
+        page by page, see SugarModule.prefetch_related
+        '''
+        q = self._clone()
+        q.related = q.related + names
+        return q
+
+    def only(self, *names):
+        '''
+        fetch only the given fields, the others are loaded on first
+        access
+        '''
+        self.module.object_class.get_properties(names)
+        q = self._clone()
+        q.fields = list(names)
+        return q
+
+    def defer(self, *names):
+        '''
+        do not fetch the given fields until they are accessed, useful
+        for large fields such as descriptions
+        '''
+        object_class = self.module.object_class
+        object_class.get_properties(names)
+        if self.fields is None:
+            fields = [prop.name for prop in object_class.sugar_properties
+                    if not prop.send_only]
+        else:
+            fields = self.fields
+        q = self._clone()
+        q.fields = [name for name in fields if name not in names]
+        return q
+
+    def compile(self):
+        '''
+        returns the (query, order_by) strings sent to the server
+        '''
+        return (' AND '.join(self.clauses), ', '.join(self.ordering))
+
+    def __iter__(self):
+        query, order_by = self.compile()
+        backend = self.module.collection.backend
+        fields = self.fields
+        if fields is None:
+            fields = self.module.projection()
+        if fields is not None and self.related:
+            # the ids of the related members come with the pages
+            fields = fields + [name for name in self.related
+                    if name not in fields]
+        selection = self.module.selection(fields)[1]
+        offset = 0
+        remaining = self.max_count
+
+        while remaining is None or remaining > 0:
+            size = self.page_size
+            if remaining is not None:
+                size = min(size, remaining)
+
+            stream = backend.stream_entry_list(self.module.name, query,
+                    order_by, offset, selection, size, 0,
+                    self.module._hydrate)
+            count = 0
+            elements = []
+            try:
+                for e in stream:
+                    count += 1
+                    if self.related:
+                        elements.append(e)
+                    else:
+                        yield e
+            finally:
+                stream.close()
+
+            if self.related:
+                self.module.prefetch_related(elements, *self.related)
+                for e in elements:
+                    yield e
+
+            if count < size:
+                return
+            if stream.next_offset is not None:
+                offset = stream.next_offset
+            else:
+                offset += count
+            if remaining is not None:
+                remaining -= count
 
 class SugarObject(object):
+    '''
+    The field values are kept in the _values list, in the order of
+    sugar_properties, and the fields set since the last post or load
+    in the _modified bit mask (bit n for sugar_properties[n]).
+    The instances have no __dict__ as long as the subclasses declare
+    __slots__ = () too, like the ones of sugarstore do.
+    '''
+    __slots__ = ('__id', '__loaded', 'module', '_values', '_modified',
+            '__weakref__')
+
+    sugar_properties = ()
+
     def __init__(self, module, id = None):
         self.__id = id
+        self.__loaded = False
         self.module = module
+        self._values = [NotLoaded] * len(self.sugar_properties)
+        self._modified = 0
 
     def get_id(self):
         return self.__id
@@ -121,11 +905,11 @@ class SugarObject(object):
     def isnew(self):
         return self.__id is None
 
+    def is_loaded(self):
+        return self.__loaded
+
     def ismodified(self):
-        for prop in self.sugar_properties:
-            if prop._get_modified(self):
-                return True
-        return False
+        return self._modified != 0
 
     def get_post_dict(self):
         post_dict = {}
@@ -133,10 +917,15 @@ class SugarObject(object):
         if self.__id is not None:
             post_dict['id'] = self.__id
 
-        for prop in self.sugar_properties:
-            if prop._get_modified(self):
-                post_dict[prop.field_name] = prop._to_sugar_value(
-                        prop._get_raw_value(self))
+        props = self.sugar_properties
+        modified = self._modified
+        while modified:
+            # lowest bit set first
+            bit = modified & -modified
+            modified ^= bit
+            prop = props[bit.bit_length() - 1]
+            post_dict[prop.field_name] = prop._to_sugar_value(
+                    self._values[prop.index])
                 
         return post_dict
 
@@ -151,9 +940,17 @@ class SugarObject(object):
 
     def finalize_post(self, new_id):
         if self.__id is None:
-            self.__id = new_id
             self.module.new_elements.pop(
                     self.module.new_elements.index(self))
+        self._finalize_post(new_id)
+
+    def _finalize_post(self, new_id):
+        '''
+        finalize_post, without taking a new object out of the
+        new_elements of its module
+        '''
+        if self.__id is None:
+            self.__id = new_id
             self.module.elements[new_id] = self
             self.invalidate()
         else:
@@ -161,23 +958,118 @@ class SugarObject(object):
                 raise SugarOperationnalError(
                         'Posted object %s and received a new id: %s' % (
                                 self.__id, new_id))
+            self._modified = 0
+            self.module.elements.unpin(self)
 
-    def load(self):
-        d = self.module.collection.backend.get_entry(
-                self.module.name, self.id, '')
-
-        for prop in self.sugar_properties:
-            # respect flags for the property
+    def get_properties(cls, names=None):
+        '''
+        the properties for the given field names, all the properties
+        that can be received when names is None
+        '''
+        if names is None:
+            return [prop for prop in cls.sugar_properties
+                    if not prop.send_only]
+        props = []
+        for name in names:
+            for prop in cls.sugar_properties:
+                if prop.name == name:
+                    break
+            else:
+                raise ValueError('%s has no field %s' % (cls.__name__, name))
             if not prop.send_only:
-                prop._load_value(self, d[prop.field_name])
+                props.append(prop)
+        return props
+    get_properties = classmethod(get_properties)
+
+    def load(self, fields=None):
+        '''
+        fetch the values of the object from the server.
+        fields: the names of the fields to load. By default the whole
+        object is (re)loaded, or only the fields that were read on the
+        other members when the module uses adaptive projection.
+        '''
+        module = self.module
+        if fields is None:
+            if module.batch_fault_size and not self.__loaded:
+                module._batch_fault(self)
+                if self.__loaded:
+                    return
+            fields = module.projection()
+
+        props, selection = module.selection(fields)
+        d = module.collection.backend.get_entry(
+                module.name, self.id, selection)
+        self._load_dict(d, props)
+
+    def _fault(self, prop):
+        '''
+        called when the value of prop is needed but not loaded
+        '''
+        if not self.__loaded:
+            self.load()
+        if prop.is_loaded(self):
+            return
+
+        if self.module.adaptive_projection:
+            self.load([prop.name])
+        else:
+            # deferred fields, get all the missing ones at once
+            self.load([p.name for p in self.get_properties()
+                    if not p.is_loaded(self)])
+
+    def _load_dict(self, d, props=None):
+        '''
+        set the field values from an item dictionnary as returned
+        by the backend. props restricts the loaded properties, by
+        default all of them.
+        '''
+        if props is None:
+            props = self.get_properties()
+        for prop in props:
+            prop._load_value(self, d[prop.field_name])
+        self.__loaded = True
+        self.module.unloaded.discard(self.__id)
+        self._unpin_clean()
+
+    def _load_pairs(self, pairs):
+        '''
+        set the field values from (field_name, value) pairs, fields not
+        given are left unloaded
+        '''
+        fields = self.field_map
+        for name, value in pairs:
+            for prop in fields.get(name, ()):
+                if not prop.send_only:
+                    prop._load_value(self, value)
+        self.__loaded = True
+        self.module.unloaded.discard(self.__id)
+        self._unpin_clean()
+
+    def _unpin_clean(self):
+        '''
+        the object is pinned while modified, reloading the modified
+        fields makes it evictable again
+        '''
+        if not self._modified:
+            self.module.elements.unpin(self)
 
     def invalidate(self):
-        for prop in self.sugar_properties:
-            prop._cleanup(self)
+        self._values = [NotLoaded] * len(self.sugar_properties)
+        self._modified = 0
+        self.__loaded = False
+        self.module.elements.unpin(self)
+        if self.__id is not None:
+            self.module.unloaded.add(self.__id)
         
     id = property(fget = get_id)
     
 class SugarField(object):
+    '''
+    The fields are set on the SugarObject classes by init_SugarObject
+    and act as data descriptors: reading an attribute calls get_value
+    and setting it set_value, except when the value is already loaded
+    and get_value would return it as is.
+    '''
     def __init__(self, name, field_name, module=None, read_only=False,
             receive_only=False, send_only=False, mandatory=True):
         self.name = name
@@ -188,30 +1080,56 @@ class SugarField(object):
         self.send_only = send_only
         self.mandatory = mandatory
 
-        self.value_attr = '__sp_v_%s' % self.name
-        self.modified_attr = '__sp_m_%s' % self.name
+        # the position of the field in the sugar_properties of its
+        # class, set by init_SugarObject
+        self.index = None
+        self.mask = 0
+        # loaded values can be returned without calling get_value
+        get_value = getattr(type(self), 'get_value', None)
+        self.direct = getattr(get_value, 'im_func', None) \
+                is SugarField._get_value.im_func
+
+    def __get__(self, sugar_o, owner=None):
+        if sugar_o is None:
+            return self
+        if self.direct:
+            value = sugar_o._values[self.index]
+            # with adaptive projection, get_value records the read
+            if value is not NotLoaded \
+                    and not sugar_o.module.adaptive_projection:
+                return value
+        return self.get_value(sugar_o)
+
+    def __set__(self, sugar_o, value):
+        self.set_value(sugar_o, value)
+
+    def _set_index(self, index):
+        self.index = index
+        self.mask = 1 << index
 
     def is_loaded(self, sugar_o):
-        return hasattr(sugar_o, self.value_attr)
+        return sugar_o._values[self.index] is not NotLoaded
 
     def _get_raw_value(self, sugar_o):
-        return getattr(sugar_o, self.value_attr)
+        value = sugar_o._values[self.index]
+        if value is NotLoaded:
+            raise AttributeError(self.name)
+        return value
 
     def __set_raw_value(self, sugar_o, value):
-        setattr(sugar_o, self.value_attr, value)
+        sugar_o._values[self.index] = value
 
     def _get_modified(self, sugar_o):
-        return self.is_loaded(sugar_o) and \
-            getattr(sugar_o, self.modified_attr)
+        return sugar_o._modified & self.mask != 0
 
-    def __set_modified(self, sugar_o, value):
-        setattr(sugar_o, self.modified_attr, value)
+    def _clear_modified(self, sugar_o):
+        sugar_o._modified &= ~self.mask
+        sugar_o._unpin_clean()
 
     def _cleanup(self, sugar_o):
-        if hasattr(sugar_o, self.value_attr):
-            delattr(sugar_o, self.value_attr)
-        if hasattr(sugar_o, self.modified_attr):
-            delattr(sugar_o, self.modified_attr)
+        sugar_o._values[self.index] = NotLoaded
+        sugar_o._modified &= ~self.mask
+        sugar_o._unpin_clean()
 
     def _from_sugar_value(self, value):
         return value
@@ -222,19 +1140,25 @@ class SugarField(object):
     def _load_value(self, sugar_o, value):
         self.__set_raw_value(
                 sugar_o, self._from_sugar_value(value))
-        self.__set_modified(sugar_o, False)
+        if sugar_o._modified:
+            sugar_o._modified &= ~self.mask
 
     def _set_value(self, sugar_o, value):
         if not sugar_o.isnew() and \
                 not self.is_loaded(sugar_o):
-            sugar_o.load()
+            sugar_o._fault(self)
+        sugar_o.module.elements.pin(sugar_o)
         self.__set_raw_value(sugar_o, value)
-        self.__set_modified(sugar_o, True)
+        sugar_o._modified |= self.mask
 
     def _get_value(self, sugar_o):
+        module = sugar_o.module
+        if module.adaptive_projection:
+            module.read_fields.add(self.name)
+
         if not sugar_o.isnew() \
-                and not hasattr(sugar_o, self.value_attr):
-            sugar_o.load()
+                and sugar_o._values[self.index] is NotLoaded:
+            sugar_o._fault(self)
 
         return self._get_raw_value(sugar_o)
 
@@ -381,6 +1305,10 @@ class SugarBooleanField(SugarField):
             return '0'
 
 class SugarPropertyGetter:
+    '''
+    deprecated: the fields are their own descriptors now. Kept for the
+    code building properties around a field itself.
+    '''
     def __init__(self, sugar_field):
         self.sugar_field = sugar_field
 
@@ -388,6 +1316,9 @@ class SugarPropertyGetter:
         return self.sugar_field.get_value(sugar_o)
 
 class SugarPropertySetter:
+    '''
+    deprecated, see SugarPropertyGetter
+    '''
     def __init__(self, sugar_field):
         self.sugar_field = sugar_field
 
@@ -396,14 +1327,17 @@ class SugarPropertySetter:
 
 
 def create_property(sugar_field):
-    return property(
-            fget = SugarPropertyGetter(sugar_field),
-            fset = SugarPropertySetter(sugar_field));
+    # the fields are their own descriptors
+    return sugar_field
 
 def init_SugarObject(sugar_object_class, fields):
     sugar_object_class.sugar_properties = []
+    # sugar field name -> properties loaded from it
+    sugar_object_class.field_map = {}
     for f, p in fields:
+        f._set_index(len(sugar_object_class.sugar_properties))
         sugar_object_class.sugar_properties.append(f)
+        sugar_object_class.field_map.setdefault(f.field_name, []).append(f)
         setattr(sugar_object_class, f.name, p)
 
 def sugar_field(name, read_only=False, receive_only=False,
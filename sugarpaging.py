@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Paging helpers for the get_entry_list calls of the pysugar library
+#
+import sys
+import threading
+import Queue
+
+DefaultPageSize = 200
+
+def is_last_page(page, offset, page_size):
+    '''
+    tells if page, fetched at offset, is the last one of the result set
+    '''
+    if len(page) < page_size:
+        return True
+    # a server sending no next offset is followed by page length
+    next_offset = getattr(page, 'next_offset', None)
+    return next_offset is not None and next_offset <= offset
+
+def next_page_offset(page, offset):
+    '''
+    the offset of the page following page, as told by the server when
+    it did, or computed from the page length otherwise
+    '''
+    next_offset = getattr(page, 'next_offset', None)
+    if next_offset is None:
+        next_offset = offset + len(page)
+    return next_offset
+
+class SugarPagePrefetcher(object):
+    '''
+    Fetches pages on a background thread, one page ahead of the
+    consumer: while page N is being processed, page N+1 is already
+    on its way.
+
+    fetch: a callable taking (offset, max_results) and returning a
+        list of entries, usually a SugarEntryList
+    '''
+    # how often a blocked thread checks that it was not asked to stop
+    poll_interval = 0.1
+
+    def __init__(self, fetch, page_size=DefaultPageSize, offset=0):
+        self.fetch = fetch
+        self.page_size = page_size
+        self.offset = offset
+        # one finished page waiting, one page being fetched
+        self.queue = Queue.Queue(1)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.isSet():
+            try:
+                self.queue.put(item, True, self.poll_interval)
+                return
+            except Queue.Full:
+                pass
+
+    def _run(self):
+        offset = self.offset
+        try:
+            while not self.stopped.isSet():
+                page = self.fetch(offset, self.page_size)
+                self._put((page, None))
+                if is_last_page(page, offset, self.page_size):
+                    break
+                offset = next_page_offset(page, offset)
+        except Exception:
+            self._put((None, sys.exc_info()))
+            return
+        self._put((None, None))
+
+    def __iter__(self):
+        while True:
+            page, exc_info = self.queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if page is None:
+                return
+            yield page
+
+    def close(self):
+        '''
+        tell the background thread to stop fetching pages
+        '''
+        self.stopped.set()
+
+class SugarParallelExporter(object):
+    '''
+    Fetches the pages of a result set with several worker threads and
+    gives them back in order, so the entries come out sorted as asked
+    by the order_by of the query.
+
+    The first page is read on the calling thread. When the server
+    sends the total number of matching entries (total_count) the
+    exact page range is split between the workers; otherwise the
+    workers keep claiming the following offsets until a short page
+    marks the end of the result set.
+
+    fetch: a callable taking (offset, max_results) and returning a
+        list of entries. It is called concurrently from the workers,
+        each call should use its own connection.
+    workers: the number of worker threads
+    max_in_flight: the maximum number of pages being fetched or
+        waiting to be consumed, defaults to twice the number of workers
+    total: the number of entries to export when it is already known
+    '''
+    def __init__(self, fetch, page_size=DefaultPageSize, workers=4,
+            max_in_flight=None, total=None, offset=0):
+        self.fetch = fetch
+        self.page_size = page_size
+        self.workers = workers
+        self.max_in_flight = max_in_flight or 2 * workers
+        self.total = total
+        self.offset = offset
+
+        self.cond = threading.Condition()
+        self.pages = {}
+        self.next_index = 0
+        self.last_index = None
+        self.in_flight = 0
+        self.exc_info = None
+        self.stopped = False
+
+    def _set_last_index(self, index):
+        if self.last_index is None or index < self.last_index:
+            self.last_index = index
+
+    def _claim(self):
+        '''
+        returns the index of the next page to fetch, or None when
+        there is nothing left to do
+        '''
+        self.cond.acquire()
+        try:
+            while not self.stopped and self.in_flight >= self.max_in_flight:
+                self.cond.wait()
+            if self.stopped:
+                return None
+            if self.last_index is not None \
+                    and self.next_index > self.last_index:
+                return None
+            index = self.next_index
+            self.next_index += 1
+            self.in_flight += 1
+            return index
+        finally:
+            self.cond.release()
+
+    def _work(self):
+        while True:
+            index = self._claim()
+            if index is None:
+                return
+            try:
+                page = self.fetch(self.offset + index * self.page_size,
+                        self.page_size)
+            except Exception:
+                self.cond.acquire()
+                try:
+                    if self.exc_info is None:
+                        self.exc_info = sys.exc_info()
+                    self.stopped = True
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+                return
+
+            self.cond.acquire()
+            try:
+                self.pages[index] = page
+                if len(page) < self.page_size:
+                    self._set_last_index(index)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def _next_page(self, index):
+        self.cond.acquire()
+        try:
+            while index not in self.pages and self.exc_info is None:
+                self.cond.wait()
+            if self.exc_info is not None:
+                exc_info = self.exc_info
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.in_flight -= 1
+            self.cond.notifyAll()
+            return self.pages.pop(index)
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        '''
+        ask the workers to stop after their current page
+        '''
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def iter_pages(self):
+        '''
+        generator over the pages, in offset order
+        '''
+        first = self.fetch(self.offset, self.page_size)
+        yield first
+        if len(first) < self.page_size:
+            return
+
+        total = self.total
+        if total is None:
+            total = getattr(first, 'total_count', None)
+        if total is not None:
+            if total <= self.page_size:
+                return
+            self.last_index = (total - 1) // self.page_size
+        self.next_index = 1
+
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+        try:
+            index = 1
+            while self.last_index is None or index <= self.last_index:
+                yield self._next_page(index)
+                index += 1
+        finally:
+            self.stop()
+
+    def __iter__(self):
+        for page in self.iter_pages():
+            for entry in page:
+                yield entry
+
+def iter_pages(fetch, page_size=DefaultPageSize, offset=0, prefetch=True):
+    '''
+    generator over the pages of a result set, following the next
+    offsets until a short page comes back.
+    With prefetch, the next page is fetched in the background while
+    the current one is consumed.
+    '''
+    if not prefetch:
+        while True:
+            page = fetch(offset, page_size)
+            yield page
+            if is_last_page(page, offset, page_size):
+                return
+            offset = next_page_offset(page, offset)
+
+    prefetcher = SugarPagePrefetcher(fetch, page_size, offset)
+    try:
+        for page in prefetcher:
+            yield page
+    finally:
+        prefetcher.close()
+
+def iter_entries(fetch, page_size=DefaultPageSize, offset=0, prefetch=True):
+    '''
+    same as iter_pages but yields the entries one by one
+    '''
+    for page in iter_pages(fetch, page_size, offset, prefetch):
+        for entry in page:
+            yield entry
+
+# vim: expandtab tabstop=4 shiftwidth=4:
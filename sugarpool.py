@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# A pool of logged in sessions for the pysugar library
+#
+import threading
+import time
+from contextlib import contextmanager
+from pysugar import SugarSession, SugarError
+from sugartransport import SugarConnectionPool
+
+DefaultPoolSize = 4
+DefaultCheckInterval = 300
+
+class SugarPoolTimeoutError(SugarError):
+    '''
+    raised when no session could be checked out of a SugarSessionPool
+    before the wait timeout
+    '''
+    pass
+
+class SugarSessionPool(object):
+    '''
+    Holds up to size logged in SugarSession objects for the same server
+    and user, so that several threads can make calls at the same time,
+    each one with a session of its own:
+
+        pool = SugarSessionPool('myuser', 'mypass', 'http://myserver/sugar')
+        session = pool.checkout()
+        try:
+            lead = session.get_entry('Leads', lead_id, ['last_name'])
+        finally:
+            pool.checkin(session)
+
+    or, shorter:
+
+        with pool.session() as session:
+            lead = session.get_entry('Leads', lead_id, ['last_name'])
+
+    size: the maximum number of sessions, they are opened on demand
+    wait_timeout: how long checkout waits for a free session before a
+        SugarPoolTimeoutError is raised, None means forever
+    check_interval: a session that was not checked for this many
+        seconds is asked for its user id before being handed out, and
+        logged in again if the server forgot it. 0 checks every time.
+    connection_pool: the sugartransport.SugarConnectionPool shared by
+        all the sessions, by default one with size connections per host
+    session_args: extra keyword arguments for the SugarSession
+        constructor. The sessions are opened with fast_connect and
+        without debug unless told otherwise. Do not give a
+        session_store, the sessions of the pool would all reuse the
+        same session id.
+    '''
+    def __init__(self, username, password, base_url, size=DefaultPoolSize,
+            wait_timeout=None, check_interval=DefaultCheckInterval,
+            connection_pool=None, **session_args):
+        self.username = username
+        self.password = password
+        self.base_url = base_url
+        self.size = size
+        self.wait_timeout = wait_timeout
+        self.check_interval = check_interval
+        if connection_pool is None:
+            connection_pool = SugarConnectionPool(max_size=size,
+                    max_per_host=size)
+        self.connection_pool = connection_pool
+        session_args.setdefault('debug', False)
+        session_args.setdefault('fast_connect', True)
+        self.session_args = session_args
+
+        self.lock = threading.Condition()
+        # sessions waiting to be checked out, most recently used last
+        self.idle = []
+        # session -> time of its last health check
+        self.checked_at = {}
+        self.opened = 0
+        self.closed = False
+        self.stats = {
+                'checkouts': 0,
+                'created': 0,
+                'discarded': 0,
+                'waits': 0,
+                'wait_time': 0.0,
+                'max_wait_time': 0.0,
+                'timeouts': 0,
+                'health_checks': 0,
+                'relogins': 0,
+                }
+
+    def _new_session(self):
+        session = SugarSession(self.username, self.password, self.base_url,
+                connection_pool=self.connection_pool, **self.session_args)
+        self.lock.acquire()
+        try:
+            self.stats['created'] += 1
+            self.checked_at[session] = time.time()
+        finally:
+            self.lock.release()
+        return session
+
+    def _count(self, name):
+        self.lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self.lock.release()
+
+    def _check(self, session):
+        '''
+        make sure the server still knows the session, returns False if
+        it cannot be used anymore
+        '''
+        if time.time() - self.checked_at.get(session, 0) < self.check_interval:
+            return True
+        self._count('health_checks')
+        try:
+            if session.get_user_id() == '-1':
+                self._count('relogins')
+                session.login(self.username, self.password)
+        except Exception:
+            # SugarError, or a transport, socket or httplib error
+            return False
+        self.checked_at[session] = time.time()
+        return True
+
+    def _forget(self, session=None):
+        '''
+        frees the slot of a session that is dropped, or that could not
+        be opened when session is None
+        '''
+        self.lock.acquire()
+        try:
+            self.opened -= 1
+            if session is not None:
+                self.checked_at.pop(session, None)
+                self.stats['discarded'] += 1
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def _take(self, timeout):
+        '''
+        returns an idle session, or None when the caller may open a
+        new one
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        start = time.time()
+        waited = False
+
+        self.lock.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise SugarError('the session pool is closed')
+                if self.idle:
+                    session = self.idle.pop()
+                    break
+                if self.opened < self.size:
+                    # the slot is taken now, the session is opened
+                    # without holding the lock
+                    self.opened += 1
+                    session = None
+                    break
+                if deadline is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise SugarPoolTimeoutError(
+                            'no free session after %s seconds' % timeout)
+                if not waited:
+                    waited = True
+                    self.stats['waits'] += 1
+                self.lock.wait(remaining)
+
+            self.stats['checkouts'] += 1
+            if waited:
+                wait_time = time.time() - start
+                self.stats['wait_time'] += wait_time
+                self.stats['max_wait_time'] = max(
+                        self.stats['max_wait_time'], wait_time)
+            return session
+        finally:
+            self.lock.release()
+
+    def checkout(self, timeout=None):
+        '''
+        returns a logged in session for the exclusive use of the caller,
+        who must give it back with checkin. timeout overrides the
+        wait_timeout of the pool.
+        '''
+        if timeout is None:
+            timeout = self.wait_timeout
+        while True:
+            session = self._take(timeout)
+            if session is None:
+                try:
+                    return self._new_session()
+                except:
+                    self._forget()
+                    raise
+            try:
+                healthy = self._check(session)
+            except:
+                self._forget(session)
+                raise
+            if healthy:
+                return session
+            self._forget(session)
+
+    def checkin(self, session, discard=False):
+        '''
+        give a session back to the pool. A discarded session is dropped
+        and will be replaced by a new one when needed.
+        '''
+        if discard or self.closed:
+            self._forget(session)
+            if self.closed:
+                self._logout(session)
+            return
+        self.lock.acquire()
+        try:
+            self.idle.append(session)
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def session(self, timeout=None):
+        '''
+        checks a session out for the duration of a with block
+        '''
+        session = self.checkout(timeout)
+        try:
+            yield session
+        finally:
+            self.checkin(session)
+
+    def run(self, fn, *args, **kw):
+        '''
+        calls fn(session, *args, **kw) with a session of the pool and
+        returns its result
+        '''
+        session = self.checkout()
+        try:
+            return fn(session, *args, **kw)
+        finally:
+            self.checkin(session)
+
+    def _logout(self, session):
+        try:
+            session.logout()
+        except SugarError:
+            pass
+
+    def close(self):
+        '''
+        log out the idle sessions, the ones still checked out are
+        logged out when they come back
+        '''
+        self.lock.acquire()
+        try:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+        for session in idle:
+            self._forget(session)
+            self._logout(session)
+
+    def get_stats(self):
+        '''
+        returns a dictionnary with the pool counters, the number of open,
+        idle and checked out sessions and the stats of the connection pool
+        under 'connections'
+        '''
+        self.lock.acquire()
+        try:
+            stats = dict(self.stats)
+            stats['size'] = self.size
+            stats['open'] = self.opened
+            stats['idle'] = len(self.idle)
+            stats['busy'] = self.opened - len(self.idle)
+        finally:
+            self.lock.release()
+        stats['connections'] = self.connection_pool.get_stats()
+        return stats
+
+Interactive = 'interactive'
+Bulk = 'bulk'
+
+class SugarPriorityScheduler(object):
+    '''
+    Hands out the sessions of a SugarSessionPool to two classes of
+    callers, so that bulk jobs cannot make the interactive calls wait:
+
+    - an interactive caller is always served before a bulk one
+    - bulk callers never hold more than pool.size - reserved sessions,
+      the reserved ones stay available for interactive calls
+
+        scheduler = SugarPriorityScheduler(pool, reserved=2)
+        # in a view
+        with scheduler.session() as session:
+            lead = session.get_entry('Leads', lead_id, ['last_name'])
+        # in the nightly job
+        with scheduler.session(Bulk) as session:
+            session.set_entries('Leads', items)
+
+    All the checkouts of the pool should go through the scheduler.
+    get_stats() gives for each class the number of callers queued, the
+    time they waited and the number of sessions they hold.
+    '''
+    def __init__(self, pool, reserved=1):
+        if reserved >= pool.size:
+            raise ValueError('reserved must leave sessions for bulk calls')
+        self.pool = pool
+        self.reserved = reserved
+        self.cond = threading.Condition()
+        # session -> class of the caller holding it
+        self.holders = {}
+        self.stats = {}
+        for priority in (Interactive, Bulk):
+            self.stats[priority] = {
+                    'checkouts': 0,
+                    'busy': 0,
+                    'queued': 0,
+                    'max_queued': 0,
+                    'waits': 0,
+                    'wait_time': 0.0,
+                    'max_wait_time': 0.0,
+                    'timeouts': 0,
+                    }
+
+    def _can_go(self, priority):
+        interactive = self.stats[Interactive]
+        bulk = self.stats[Bulk]
+        if interactive['busy'] + bulk['busy'] >= self.pool.size:
+            return False
+        if priority == Interactive:
+            return True
+        # bulk calls give way to the queued interactive ones and leave
+        # the reserved sessions alone
+        return not interactive['queued'] \
+                and bulk['busy'] < self.pool.size - self.reserved
+
+    def _wait_turn(self, priority, timeout):
+        '''
+        wait until a caller of priority may check a session out, returns
+        what is left of timeout
+        '''
+        stats = self.stats[priority]
+        start = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout
+
+        self.cond.acquire()
+        try:
+            if not self._can_go(priority):
+                stats['waits'] += 1
+                stats['queued'] += 1
+                stats['max_queued'] = max(stats['max_queued'],
+                        stats['queued'])
+                try:
+                    while not self._can_go(priority):
+                        if deadline is None:
+                            remaining = None
+                        else:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                stats['timeouts'] += 1
+                                raise SugarPoolTimeoutError('no free %s '
+                                    'session after %s seconds' % (
+                                    priority, timeout))
+                        self.cond.wait(remaining)
+                finally:
+                    stats['queued'] -= 1
+                    # a bulk caller may go now that this one left
+                    self.cond.notifyAll()
+                wait_time = time.time() - start
+                stats['wait_time'] += wait_time
+                stats['max_wait_time'] = max(stats['max_wait_time'],
+                        wait_time)
+            stats['busy'] += 1
+            stats['checkouts'] += 1
+        finally:
+            self.cond.release()
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def _leave(self, priority):
+        self.cond.acquire()
+        try:
+            self.stats[priority]['busy'] -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def checkout(self, priority=Interactive, timeout=None):
+        '''
+        returns a session of the pool for a caller of the given class,
+        Interactive or Bulk. timeout defaults to the wait_timeout of
+        the pool.
+        '''
+        if priority not in self.stats:
+            raise ValueError('unknown priority class: %s' % priority)
+        if timeout is None:
+            timeout = self.pool.wait_timeout
+        # the pool only gets the time the turn left
+        timeout = self._wait_turn(priority, timeout)
+        try:
+            session = self.pool.checkout(timeout)
+        except:
+            self._leave(priority)
+            raise
+        self.cond.acquire()
+        try:
+            self.holders[session] = priority
+        finally:
+            self.cond.release()
+        return session
+
+    def checkin(self, session, discard=False):
+        '''
+        give a session back, see SugarSessionPool.checkin
+        '''
+        self.cond.acquire()
+        try:
+            priority = self.holders.pop(session)
+        finally:
+            self.cond.release()
+        try:
+            self.pool.checkin(session, discard)
+        finally:
+            self._leave(priority)
+
+    @contextmanager
+    def session(self, priority=Interactive, timeout=None):
+        '''
+        checks a session out for the duration of a with block
+        '''
+        session = self.checkout(priority, timeout)
+        try:
+            yield session
+        finally:
+            self.checkin(session)
+
+    def run(self, priority, fn, *args, **kw):
+        '''
+        calls fn(session, *args, **kw) with a session given to the
+        priority class and returns its result
+        '''
+        session = self.checkout(priority)
+        try:
+            return fn(session, *args, **kw)
+        finally:
+            self.checkin(session)
+
+    def get_stats(self):
+        '''
+        returns a dictionnary with the counters of each class, under
+        Interactive and Bulk, and the stats of the pool under 'pool'
+        '''
+        self.cond.acquire()
+        try:
+            stats = {}
+            for priority, counters in self.stats.items():
+                stats[priority] = dict(counters)
+        finally:
+            self.cond.release()
+        stats['pool'] = self.pool.get_stats()
+        return stats
+
+# vim: expandtab tabstop=4 shiftwidth=4:
@@ -17,6 +17,7 @@ from sugarobjects import sugar_str_field, sugar_date_field, \
         init_SugarObject
 
 class Lead(SugarObject):
+    __slots__ = ()
     table_name = 'leads'
 
 class User(SugarObject):
@@ -31,12 +32,15 @@ class User(SugarObject):
         user.employee_status = 'Active'
         
     '''
+    __slots__ = ()
     table_name = 'users'
 
 class Task(SugarObject):
+    __slots__ = ()
     table_name = 'tasks'
 
 class Meeting(SugarObject):
+    __slots__ = ()
     table_name = 'meetings'
 
 init_SugarObject(
@@ -201,9 +205,13 @@ init_SugarObject(
         ])
         
 class SugarStore(object):
-    def __init__(self, sugar_session):
+    '''
+    capacity and weak configure the identity maps of the modules,
+    see sugarobjects.SugarIdentityMap
+    '''
+    def __init__(self, sugar_session, capacity=None, weak=False):
         self.backend = sugar_session
-        self.m = SugarModuleCollection(self.backend)
+        self.m = SugarModuleCollection(self.backend, capacity, weak)
         self.m.add('Leads', Lead)
         self.m.add('Users', User)
         self.m.add('Meetings', Meeting)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Keep-alive HTTP transport for the pysugar library
+#
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+DefaultPoolSize = 10
+DefaultMaxPerHost = 4
+DefaultIdleTimeout = 60
+
+class SugarTransportError(Exception):
+    '''
+    raised when the pool cannot provide a connection in time
+    '''
+    pass
+
+def closed_unanswered(error):
+    '''
+    tells if the error got while waiting for an answer means that the
+    server closed the connection before sending anything back
+    '''
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        # the older pythons give the empty status line
+        return not error.line or error.line.startswith('No status line')
+    if isinstance(error, socket.error):
+        return getattr(error, 'errno', None) == errno.ECONNRESET
+    return False
+
+class SugarPooledResponse(object):
+    '''
+    wraps an httplib response obtained from a SugarConnectionPool.
+    The underlying connection goes back to the pool when release()
+    is called, provided the response has been read completely and the
+    server did not ask to close the connection.
+    '''
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self, amt=None):
+        if amt is None:
+            return self.response.read()
+        return self.response.read(amt)
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def release(self):
+        '''
+        hand the connection back to the pool. Calling this more than
+        once does nothing.
+        '''
+        if self.conn is None:
+            return
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.pool.release(self.key, self.conn, reusable)
+        self.conn = None
+
+class SugarConnectionPool(object):
+    '''
+    A thread safe pool of persistent HTTP(S) connections.
+
+    max_size: the maximum number of connections (idle and in use) the
+        pool will hold for all hosts
+    max_per_host: the maximum number of connections opened to the same
+        scheme/host/port
+    idle_timeout: idle connections older than this (in seconds) are
+        closed instead of being reused
+    timeout: the socket timeout used for new connections, None means
+        the global default
+    wait_timeout: how long a request waits for a free connection before
+        a SugarTransportError is raised, None means forever
+
+    A single pool can be shared by several SugarService instances.
+    '''
+    def __init__(self, max_size=DefaultPoolSize,
+            max_per_host=DefaultMaxPerHost, idle_timeout=DefaultIdleTimeout,
+            timeout=None, wait_timeout=None):
+        self.max_size = max_size
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+
+        self.lock = threading.Condition()
+        # (scheme, host, port) -> list of (connection, last use time)
+        self.idle = {}
+        # (scheme, host, port) -> number of connections handed out
+        self.busy = {}
+        self.stats = {
+                'requests': 0,
+                'created': 0,
+                'reused': 0,
+                'closed': 0,
+                'retried': 0,
+                'waits': 0,
+                }
+
+    def _count(self):
+        total = sum(self.busy.values())
+        for conns in self.idle.values():
+            total += len(conns)
+        return total
+
+    def _host_count(self, key):
+        return self.busy.get(key, 0) + len(self.idle.get(key, []))
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except socket.error:
+            pass
+        self.stats['closed'] += 1
+
+    def _prune(self, now):
+        '''
+        drop idle connections that outlived the idle timeout.
+        Must be called with the lock held.
+        '''
+        for key, conns in self.idle.items():
+            fresh = []
+            for conn, last_used in conns:
+                if now - last_used > self.idle_timeout:
+                    self._close(conn)
+                else:
+                    fresh.append((conn, last_used))
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+    def _evict_one(self):
+        '''
+        close the oldest idle connection of any host to make room.
+        Must be called with the lock held.
+        '''
+        oldest = None
+        for key, conns in self.idle.items():
+            if conns and (oldest is None or conns[0][1] < oldest[1]):
+                oldest = (key, conns[0][1])
+        if oldest is None:
+            return False
+        key = oldest[0]
+        conn, last_used = self.idle[key].pop(0)
+        if not self.idle[key]:
+            del self.idle[key]
+        self._close(conn)
+        return True
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        if self.timeout is None:
+            conn = conn_class(host, port)
+        else:
+            conn = conn_class(host, port, timeout=self.timeout)
+        self.stats['created'] += 1
+        return conn
+
+    def acquire(self, key):
+        '''
+        returns a 2-tuple (connection, reused) for the given
+        (scheme, host, port) key, waiting for a free slot if needed
+        '''
+        deadline = None
+        if self.wait_timeout is not None:
+            deadline = time.time() + self.wait_timeout
+
+        self.lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                self._prune(now)
+                conns = self.idle.get(key)
+                if conns:
+                    # most recently used first, it is the most likely
+                    # to still be open on the server side
+                    conn, last_used = conns.pop()
+                    if not conns:
+                        del self.idle[key]
+                    self.busy[key] = self.busy.get(key, 0) + 1
+                    self.stats['reused'] += 1
+                    return (conn, True)
+
+                if self._host_count(key) < self.max_per_host:
+                    if self._count() < self.max_size or self._evict_one():
+                        self.busy[key] = self.busy.get(key, 0) + 1
+                        return (self._new_connection(key), False)
+
+                if deadline is None:
+                    remaining = None
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise SugarTransportError(
+                            'no connection available for %s://%s:%s' % key)
+                self.stats['waits'] += 1
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+
+    def release(self, key, conn, reusable=True):
+        '''
+        give a connection back to the pool. Connections that
+        cannot be reused are closed.
+        '''
+        self.lock.acquire()
+        try:
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+            if reusable:
+                self.idle.setdefault(key, []).append((conn, time.time()))
+            else:
+                self._close(conn)
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def request(self, url, body, headers=None, method='POST'):
+        '''
+        send a request to the given url using a pooled connection and
+        return a SugarPooledResponse. The caller must release() the
+        response once it has been read.
+
+        A request sent on a reused connection that the server has
+        closed in the meantime is transparently retried on another
+        connection, when the request could not be sent or the
+        server closed the connection without answering anything.
+        Once the request is sent, a timeout or any other error is
+        raised: the server may have run the call already.
+        '''
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme not in ('http', 'https'):
+            raise ValueError('unsupported url scheme: %s' % scheme)
+        if '@' in netloc:
+            raise ValueError('credentials in the url are not supported')
+        host, sep, port = netloc.rpartition(':')
+        if not sep or not port.isdigit():
+            host = netloc
+            if scheme == 'https':
+                port = httplib.HTTPS_PORT
+            else:
+                port = httplib.HTTP_PORT
+        key = (scheme, host, int(port))
+        if query:
+            path = '%s?%s' % (path, query)
+        path = path or '/'
+
+        all_headers = {'Connection': 'keep-alive'}
+        if headers:
+            all_headers.update(headers)
+
+        self.lock.acquire()
+        try:
+            self.stats['requests'] += 1
+        finally:
+            self.lock.release()
+
+        while True:
+            conn, reused = self.acquire(key)
+            sent = False
+            try:
+                conn.request(method, path, body, all_headers)
+                sent = True
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                self.release(key, conn, False)
+                if reused and not isinstance(e, socket.timeout) \
+                        and (not sent or closed_unanswered(e)):
+                    self.lock.acquire()
+                    try:
+                        self.stats['retried'] += 1
+                    finally:
+                        self.lock.release()
+                    continue
+                raise
+            except:
+                self.release(key, conn, False)
+                raise
+            return SugarPooledResponse(self, key, conn, response)
+
+    def get_stats(self):
+        '''
+        returns a dictionnary with the pool counters and the number
+        of idle and busy connections
+        '''
+        self.lock.acquire()
+        try:
+            stats = dict(self.stats)
+            stats['busy'] = sum(self.busy.values())
+            stats['idle'] = sum([len(c) for c in self.idle.values()])
+        finally:
+            self.lock.release()
+        return stats
+
+    def clear(self):
+        '''
+        close all the idle connections
+        '''
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn, last_used in conns:
+                    self._close(conn)
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# A minimal SugarCRM SOAP server for the pysugar tests
+#
+import re
+import socket
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from xml.etree.ElementTree import Element, SubElement, fromstring, tostring
+
+NS_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+InvalidSession = 11
+
+def sample_data():
+    '''
+    25 leads L00..L24 assigned to the users U0..U2
+    '''
+    data = {'Leads': {}, 'Users': {}}
+    for i in range(25):
+        id = 'L%02d' % i
+        data['Leads'][id] = {
+                'id': id,
+                'status': 'New',
+                'last_name': 'n%d' % i,
+                'assigned_user_id': 'U%d' % (i % 3),
+                'deleted': '0',
+                'date_entered': '2006-10-17 12:33:25',
+                }
+    for i in range(3):
+        id = 'U%d' % i
+        data['Users'][id] = {'id': id, 'user_name': 'user%d' % i}
+    return data
+
+class FakeSugar(object):
+    '''
+    Answers the calls pysugar makes, from the records in data. The
+    actions received are logged in calls. latency delays every answer,
+    fail maps an action to a function called with the request, that can
+    raise to make the server answer with a SOAP fault (and an HTTP 500)
+    holding the message of the exception.
+    '''
+    def __init__(self):
+        self.data = sample_data()
+        self.calls = []
+        self.sessions = set()
+        self.latency = 0.0
+        self.fail = {}
+        self.lock = threading.Lock()
+        self.connections = []
+        self.threads = []
+
+    def start(self):
+        '''
+        serves on a random local port, returns the base url
+        '''
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                fake.connections.append(self.connection)
+                fake.threads.append(threading.currentThread())
+
+            def do_GET(self):
+                # SugarSession checks that the soap url answers
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                request = fromstring(body).find('{%s}Body' % NS_ENV)[0]
+                try:
+                    status, answer = 200, fake.answer(request)
+                except Exception, e:
+                    status, answer = 500, fake.fault(str(e))
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # the connections cut by stop()
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # end the kept alive connections, their threads are waiting
+        # for another request
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for thread in self.threads:
+            thread.join(1)
+
+    def answer(self, request):
+        action = request.tag
+        self.lock.acquire()
+        try:
+            self.calls.append(action)
+        finally:
+            self.lock.release()
+        if self.latency:
+            time.sleep(self.latency)
+        if action in self.fail:
+            self.fail[action](request)
+
+        response = Element(action + 'Response')
+        ret = SubElement(response, 'return')
+        session = request.findtext('session')
+        if action == 'login':
+            self.lock.acquire()
+            try:
+                session = 'S%d' % len(self.calls)
+                self.sessions.add(session)
+            finally:
+                self.lock.release()
+            SubElement(ret, 'id').text = session
+            self.error(ret)
+        elif action == 'get_gmt_time':
+            ret.text = '2006-10-17 12:33:25'
+        elif action == 'logout':
+            self.sessions.discard(session)
+            SubElement(ret, 'number').text = '0'
+        elif action == 'get_user_id':
+            if session in self.sessions:
+                ret.text = 'U0'
+            else:
+                ret.text = '-1'
+        elif session not in self.sessions:
+            self.error(ret, InvalidSession)
+            SubElement(ret, 'entry_list')
+        else:
+            getattr(self, action)(request, ret)
+            self.error(ret)
+
+        return self.envelope(response)
+
+    def envelope(self, element):
+        envelope = Element('{%s}Envelope' % NS_ENV)
+        SubElement(envelope, '{%s}Body' % NS_ENV).append(element)
+        return tostring(envelope)
+
+    def fault(self, faultstring):
+        fault = Element('{%s}Fault' % NS_ENV)
+        SubElement(fault, 'faultcode').text = 'SOAP-ENV:Server'
+        SubElement(fault, 'faultstring').text = faultstring
+        return self.envelope(fault)
+
+    def error(self, ret, number=0):
+        error = SubElement(ret, 'error')
+        SubElement(error, 'number').text = str(number)
+        if number:
+            SubElement(error, 'name').text = 'Invalid Session ID'
+        else:
+            SubElement(error, 'name').text = 'No Error'
+        SubElement(error, 'description').text = ''
+
+    def selection(self, request, name):
+        element = request.find(name)
+        if element is None:
+            return None
+        fields = [item.text for item in element.findall('item')]
+        if not fields and element.text:
+            fields = element.text.split(',')
+        return fields or None
+
+    def entry(self, parent, module, record, fields=None):
+        item = SubElement(parent, 'item')
+        SubElement(item, 'id').text = record['id']
+        SubElement(item, 'module_name').text = module
+        name_values = SubElement(item, 'name_value_list')
+        for name, value in sorted(record.items()):
+            if fields and name not in fields and name != 'id':
+                continue
+            pair = SubElement(name_values, 'item')
+            SubElement(pair, 'name').text = name
+            SubElement(pair, 'value').text = value
+
+    def get_entry(self, request, ret):
+        module = request.findtext('module')
+        entry_list = SubElement(ret, 'entry_list')
+        self.entry(entry_list, module,
+                self.data[module][request.findtext('id')],
+                self.selection(request, 'selection'))
+
+    def get_entries(self, request, ret):
+        module = request.findtext('module')
+        entry_list = SubElement(ret, 'entry_list')
+        for id in request.find('ids').findall('item'):
+            self.entry(entry_list, module, self.data[module][id.text],
+                    self.selection(request, 'selection'))
+
+    def get_entry_list(self, request, ret):
+        module = request.findtext('module')
+        query = request.findtext('query') or ''
+        offset = int(request.findtext('offset') or 0)
+        max_results = int(request.findtext('max_results') or 20)
+
+        records = sorted(self.data[module].values(),
+                key=lambda record: record['id'])
+        if ' IN ' in query:
+            ids = re.findall(r"'([^']*)'", query)
+            records = [r for r in records if r['id'] in ids]
+        match = re.search(r"\.(\w+) = '([^']*)'", query)
+        if match:
+            records = [r for r in records
+                    if r.get(match.group(1)) == match.group(2)]
+        page = records[offset:offset + max_results]
+
+        SubElement(ret, 'result_count').text = str(len(page))
+        SubElement(ret, 'next_offset').text = str(offset + len(page))
+        SubElement(ret, 'field_list')
+        entry_list = SubElement(ret, 'entry_list')
+        for record in page:
+            self.entry(entry_list, module, record,
+                    self.selection(request, 'select_fields'))
+
+    def store(self, module, name_value_list):
+        record = {}
+        for item in name_value_list.findall('item'):
+            record[item.findtext('name')] = item.findtext('value')
+        self.lock.acquire()
+        try:
+            if 'id' not in record:
+                record['id'] = 'N%d' % len(self.data[module])
+            self.data[module].setdefault(record['id'], {}).update(record)
+        finally:
+            self.lock.release()
+        return record['id']
+
+    def set_entry(self, request, ret):
+        SubElement(ret, 'id').text = self.store(request.findtext('module'),
+                request.find('name_value_list'))
+
+    def set_entries(self, request, ret):
+        module = request.findtext('module')
+        ids = SubElement(ret, 'ids')
+        for name_value_list in request.find('name_value_lists').findall(
+                'name_value_list'):
+            SubElement(ids, 'item').text = self.store(module,
+                    name_value_list)
+
+# vim: expandtab tabstop=4 shiftwidth=4:
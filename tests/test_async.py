@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of AsyncSugarSession
+#
+import unittest
+
+from elementsoap.ElementSOAP import SoapFault
+from asyncsugar import AsyncSugarSession
+from tests.fakesugar import FakeSugar
+
+class AsyncSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        url = self.fake.start()
+        self.session = AsyncSugarSession('u', 'p', url)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def get_entries(self, count):
+        return [self.session.get_entry('Leads', 'L%02d' % i, ['last_name'])
+                for i in range(count)]
+
+    def test_gather(self):
+        self.fake.latency = 0.05
+        items = self.session.gather(self.get_entries(10))
+        self.assertEqual([item['last_name'] for item in items],
+                ['n%d' % i for i in range(10)])
+        self.assertEqual(self.fake.calls.count('login'), 1)
+        self.assertTrue(self.session.get_stats()['max_in_flight'] > 1)
+
+    def test_limit(self):
+        self.fake.latency = 0.05
+        self.session.gather(self.get_entries(6), limit=2)
+        stats = self.session.get_stats()
+        self.assertEqual(stats['max_in_flight'], 2)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_relogin(self):
+        self.session.gather([self.session.login()])
+        self.fake.sessions.clear()
+        item, = self.session.gather(self.get_entries(1))
+        self.assertEqual(item['last_name'], 'n0')
+        self.assertEqual(self.fake.calls, ['login', 'get_entry', 'login',
+                'get_entry'])
+        self.assertEqual(self.session.get_stats()['retried'], 1)
+
+    def test_errors(self):
+        def failing(request):
+            if request.findtext('id') == 'L02':
+                raise ValueError('bad id')
+        self.fake.fail['get_entry'] = failing
+        calls = self.get_entries(4)
+        results = self.session.gather(calls, return_exceptions=True)
+        self.assertTrue(isinstance(results[2], SoapFault))
+        self.assertEqual(results[3]['last_name'], 'n3')
+        self.assertRaises(SoapFault, calls[2].result)
+        self.assertRaises(SoapFault, self.session.gather, calls)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of the entry and query caches
+#
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import sugarcache
+from pysugar import SugarSession
+from sugarcache import SugarEntryCache, SugarQueryCache, SugarLRUCache, \
+        SugarSQLiteCache, SugarDjangoCache
+from tests.fakesugar import FakeSugar
+
+try:
+    from django.conf import settings
+except ImportError:
+    settings = None
+
+class Clock(object):
+    '''
+    stands for the time module in sugarcache
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.time = sugarcache.time
+        sugarcache.time = self.clock
+
+    def tearDown(self):
+        sugarcache.time = self.time
+
+class Fetcher(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return {'id': 'L01', 'count': self.count}
+
+class LRUCacheTest(ClockTestCase):
+    def test_expiry(self):
+        cache = SugarLRUCache(ttl=10)
+        cache.set('a', 1)
+        self.clock.now += 9
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.now += 2
+        self.assertEqual(cache.get('a'), None)
+
+    def test_eviction(self):
+        cache = SugarLRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        cache = SugarLRUCache(None, max_bytes=10)
+        cache.set('a', 1, size=6)
+        cache.set('b', 2, size=6)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get_stats()['bytes'], 6)
+
+class EntryCacheTest(ClockTestCase):
+    def test_hit(self):
+        cache = SugarEntryCache(ttl=10)
+        fetch = Fetcher()
+        first = cache.get_entry(fetch, 'Leads', 'L01', '')
+        first['count'] = 'changed'
+        self.assertEqual(cache.get_entry(fetch, 'Leads', 'L01', ''),
+                {'id': 'L01', 'count': 1})
+        self.assertEqual(fetch.count, 1)
+        self.assertEqual(cache.get_stats()['hits'], 1)
+
+    def test_selection_expiry(self):
+        # storing a new selection does not extend the older ones
+        cache = SugarEntryCache(ttl=1)
+        fetch = Fetcher()
+        cache.get_entry(fetch, 'Leads', 'L01', '')
+        self.clock.now += 0.7
+        cache.get_entry(fetch, 'Leads', 'L01', ['status'])
+        self.clock.now += 0.5
+        cache.get_entry(fetch, 'Leads', 'L01', '')
+        self.assertEqual(fetch.count, 3)
+        cache.get_entry(fetch, 'Leads', 'L01', ['status'])
+        self.assertEqual(fetch.count, 3)
+
+    def test_invalidate(self):
+        cache = SugarEntryCache(ttl=10)
+        fetch = Fetcher()
+        cache.get_entry(fetch, 'Leads', 'L01', '')
+        cache.get_entry(fetch, 'Leads', 'L01', ['status'])
+        cache.invalidate('Leads', 'L01')
+        cache.get_entry(fetch, 'Leads', 'L01', '')
+        cache.get_entry(fetch, 'Leads', 'L01', ['status'])
+        self.assertEqual(fetch.count, 4)
+
+    def test_clear(self):
+        cache = SugarEntryCache(ttl=10)
+        fetch = Fetcher()
+        cache.get_entry(fetch, 'Leads', 'L01', '')
+        cache.clear()
+        cache.get_entry(fetch, 'Leads', 'L01', '')
+        self.assertEqual(fetch.count, 2)
+
+class QueryCacheTest(unittest.TestCase):
+    def test_invalidate_module(self):
+        cache = SugarQueryCache(ttl=10)
+        results = []
+        def fetch():
+            results.append(len(results))
+            return [{'id': 'L%02d' % len(results)}]
+        args = ('Leads', '', '', 0, '', 10, 0)
+        cache.get_entry_list(fetch, *args)
+        cache.get_entry_list(fetch, *args)
+        cache.get_entry_list(fetch, 'Users', '', '', 0, '', 10, 0)
+        self.assertEqual(len(results), 2)
+        cache.invalidate('Leads')
+        cache.get_entry_list(fetch, *args)
+        cache.get_entry_list(fetch, 'Users', '', '', 0, '', 10, 0)
+        self.assertEqual(len(results), 3)
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared(self):
+        SugarSQLiteCache(self.path).set(('Leads', 'L01'), {'a': 1})
+        other = SugarSQLiteCache(self.path)
+        self.assertEqual(other.get(('Leads', 'L01')), {'a': 1})
+        other.delete(('Leads', 'L01'))
+        self.assertEqual(other.get(('Leads', 'L01')), None)
+
+    def test_expiry(self):
+        cache = SugarSQLiteCache(self.path)
+        cache.set('a', 1, ttl=-1)
+        self.assertEqual(cache.get('a'), None)
+
+class Counting(object):
+    '''
+    logs the calls made to a cache
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.cache, name)
+
+@unittest.skipIf(settings is None, 'Django is not installed')
+class DjangoCacheTest(ClockTestCase):
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        if not settings.configured:
+            settings.configure(CACHES={'default': {'BACKEND':
+                    'django.core.cache.backends.locmem.LocMemCache'}})
+        self.prefix = uuid.uuid4().hex
+
+    def test_generation_read_once(self):
+        cache = SugarDjangoCache(prefix=self.prefix)
+        cache.cache = counting = Counting(cache.cache)
+        cache.set('a', 1)
+        del counting.calls[:]
+        for i in range(3):
+            self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(counting.calls, ['get', 'get', 'get'])
+
+    def test_clear(self):
+        cache = SugarDjangoCache(prefix=self.prefix)
+        other = SugarDjangoCache(prefix=self.prefix)
+        cache.set('a', 1)
+        self.assertEqual(other.get('a'), 1)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+        # seen by the other processes once they check the generation
+        self.assertEqual(other.get('a'), 1)
+        self.clock.now += 5
+        self.assertEqual(other.get('a'), None)
+
+class SessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        url = self.fake.start()
+        self.session = SugarSession('u', 'p', url, debug=False,
+                entry_cache=SugarEntryCache(ttl=60),
+                query_cache=SugarQueryCache(ttl=60))
+        del self.fake.calls[:]
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_write_invalidates(self):
+        for i in range(3):
+            self.session.get_entry('Leads', 'L01', '')
+            self.session.get_entry_list('Leads', '', '', 0, '', 10, 0)
+        self.assertEqual(self.fake.calls, ['get_entry', 'get_entry_list'])
+
+        self.session.set_entry('Leads', {'id': 'L01', 'status': 'Dead'})
+        self.assertEqual(self.session.get_entry('Leads', 'L01', '')['status'],
+                'Dead')
+        self.session.get_entry_list('Leads', '', '', 0, '', 10, 0)
+        self.assertEqual(self.fake.calls, ['get_entry', 'get_entry_list',
+                'set_entry', 'get_entry', 'get_entry_list'])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
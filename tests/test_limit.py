@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of the concurrency limiter and of the batch sizer
+#
+import unittest
+
+import sugarlimit
+from pysugar import SugarConnectError
+from sugarlimit import SugarConcurrencyLimiter, SugarBatchSizer
+
+class Clock(object):
+    '''
+    stands for the time module in sugarlimit
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = SugarConcurrencyLimiter(initial=4, max_limit=8)
+        self.clock = Clock()
+        self.time = sugarlimit.time
+        sugarlimit.time = self.clock
+
+    def tearDown(self):
+        sugarlimit.time = self.time
+
+    def call(self, size, elapsed, overloaded=False, failed=False):
+        '''
+        a call of size items taking elapsed seconds, started after
+        the previous ones ended
+        '''
+        self.clock.now += 10
+        start = self.limiter.acquire()
+        self.clock.now += elapsed
+        self.limiter.release(start, overloaded, size, failed)
+
+    def test_sized_calls(self):
+        # bigger batches take longer, but not longer per item
+        for i in range(6):
+            for size in (10, 100, 400):
+                self.call(size, 0.05 + 0.001 * size)
+        stats = self.limiter.get_stats()
+        self.assertEqual(stats['decreases'], 0)
+        self.assertEqual(stats['limit'], 7)
+
+    def test_slow_call(self):
+        self.call(100, 1.0)
+        self.call(100, 3.0)
+        self.assertEqual(self.limiter.get_stats()['limit'], 2)
+
+    def test_overload(self):
+        self.call(1, 0.01, overloaded=True)
+        stats = self.limiter.get_stats()
+        self.assertEqual(stats['limit'], 2)
+        self.assertEqual(stats['errors'], 1)
+
+    def test_failed_calls_not_measured(self):
+        self.call(1, 0.001, failed=True)
+        self.call(1, 1.0)
+        stats = self.limiter.get_stats()
+        self.assertEqual(stats['decreases'], 0)
+        self.assertEqual(stats['min_latency'], 1.0)
+
+    def test_run_sized(self):
+        limiter = SugarConcurrencyLimiter()
+        self.assertEqual(limiter.run_sized(3, len, 'abc'), 3)
+        self.assertRaises(SugarConnectError, limiter.run,
+                self.fail_overloaded)
+        self.assertEqual(limiter.get_stats()['in_flight'], 0)
+        self.assertEqual(limiter.get_stats()['errors'], 1)
+
+    def fail_overloaded(self):
+        raise SugarConnectError('503')
+
+class BatchSizerTest(unittest.TestCase):
+    def test_full(self):
+        sizer = SugarBatchSizer(initial=2, max_bytes=1000)
+        self.assertFalse(sizer.full(1, 10, 10))
+        self.assertTrue(sizer.full(2, 10, 10))
+        self.assertTrue(sizer.full(1, 900, 200))
+        # a single item bigger than max_bytes still goes alone
+        self.assertFalse(sizer.full(0, 0, 2000))
+
+    def test_grows_while_faster(self):
+        sizer = SugarBatchSizer(initial=100)
+        for i in range(3):
+            sizer.record(100, 1.0)
+        self.assertEqual(sizer.size, 150)
+        for i in range(3):
+            sizer.record(150, 1.0)
+        self.assertEqual(sizer.size, 225)
+        # slower: turn back
+        for i in range(3):
+            sizer.record(225, 10.0)
+        self.assertEqual(sizer.size, 150)
+
+    def test_retry(self):
+        sizer = SugarBatchSizer(initial=100)
+        old = [Member(False)] * 10
+        new = [Member(True)] * 10
+        self.assertTrue(sizer.retry(SugarConnectError('timeout'), old))
+        self.assertEqual(sizer.size, 5)
+        self.assertFalse(sizer.retry(SugarConnectError('timeout'), new))
+        self.assertFalse(sizer.retry(ValueError('bad value'), old))
+        self.assertEqual(sizer.get_stats()['retries'], 1)
+
+class Member(object):
+    def __init__(self, new):
+        self.new = new
+
+    def isnew(self):
+        return self.new
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of the object layer: identity map, loading, queries and post
+#
+import datetime
+import gc
+import unittest
+
+from elementsoap.ElementSOAP import SoapFault
+from pysugar import SugarSession, SugarOperationnalError
+from sugarobjects import SugarModuleCollection, SugarObject, \
+        SugarIdentityMap, sugar_str_field, sugar_bool_field, \
+        sugar_datetime_field, sugar_relation_field, init_SugarObject, \
+        sql_quote, SugarPropertyGetter, SugarPropertySetter
+from tests.fakesugar import FakeSugar
+
+class Lead(SugarObject):
+    __slots__ = ()
+    table_name = 'leads'
+
+class User(SugarObject):
+    __slots__ = ()
+    table_name = 'users'
+
+init_SugarObject(Lead, [
+        sugar_str_field('status'),
+        sugar_str_field('last_name'),
+        sugar_bool_field('deleted'),
+        sugar_datetime_field('date_entered'),
+        sugar_relation_field('assigned_user', 'assigned_user_id', 'Users'),
+        ])
+init_SugarObject(User, [sugar_str_field('user_name')])
+
+def loaded(e, name):
+    '''
+    tells if the field name of e is loaded
+    '''
+    for prop in e.sugar_properties:
+        if prop.name == name:
+            return prop.is_loaded(e)
+    raise ValueError(name)
+
+class Member(object):
+    def __init__(self, id):
+        self.id = id
+
+class IdentityMapTest(unittest.TestCase):
+    def test_capacity(self):
+        evicted = []
+        elements = SugarIdentityMap(2, on_evict=evicted.append)
+        for id in 'abc':
+            elements[id] = Member(id)
+        self.assertEqual(evicted, ['a'])
+        self.assertTrue('a' not in elements)
+        self.assertEqual(sorted(elements.keys()), ['b', 'c'])
+
+    def test_pinned_members_stay(self):
+        elements = SugarIdentityMap(1)
+        a = Member('a')
+        elements['a'] = a
+        elements.pin(a)
+        elements['b'] = Member('b')
+        elements['c'] = Member('c')
+        self.assertTrue(elements.get('a') is a)
+        self.assertEqual(elements.dirty(), [a])
+        elements.unpin(a)
+        self.assertEqual(elements.dirty(), [])
+        self.assertTrue('a' in elements)
+        self.assertEqual(elements.get_stats()['pinned'], 0)
+
+    def test_pin_dropped_member(self):
+        # a member dropped from the map and fetched again is a new
+        # object, the dropped one cannot be pinned anymore
+        elements = SugarIdentityMap(1)
+        old = Member('a')
+        elements['a'] = old
+        elements['b'] = Member('b')
+        current = Member('a')
+        elements['a'] = current
+        elements.pin(current)
+        self.assertRaises(SugarOperationnalError, elements.pin, old)
+        elements.unpin(old)
+        self.assertEqual(elements.dirty(), [current])
+
+    def test_weak(self):
+        elements = SugarIdentityMap(weak=True)
+        b = Member('b')
+        elements['a'] = Member('a')
+        elements['b'] = b
+        gc.collect()
+        self.assertTrue('a' not in elements)
+        self.assertTrue(elements.get('b') is b)
+
+    def test_weak_capacity(self):
+        elements = SugarIdentityMap(1, weak=True)
+        a = Member('a')
+        elements['a'] = a
+        elements['b'] = Member('b')
+        # evicted, but still found while referenced
+        self.assertTrue(elements.get('a') is a)
+
+class StoreTestCase(unittest.TestCase):
+    capacity = None
+
+    def setUp(self):
+        self.fake = FakeSugar()
+        url = self.fake.start()
+        self.session = SugarSession('u', 'p', url, debug=False)
+        self.store = SugarModuleCollection(self.session, self.capacity)
+        self.store.add('Leads', Lead)
+        self.store.add('Users', User)
+        self.leads = self.store.Leads
+        del self.fake.calls[:]
+
+    def tearDown(self):
+        self.fake.stop()
+
+class ObjectTest(StoreTestCase):
+    capacity = 2
+
+    def test_lazy_load(self):
+        lead = self.leads.get('L01')
+        self.assertEqual(self.fake.calls, [])
+        self.assertEqual(lead.last_name, 'n1')
+        self.assertEqual(lead.deleted, False)
+        self.assertEqual(lead.date_entered,
+                datetime.datetime(2006, 10, 17, 12, 33, 25))
+        self.assertEqual(lead.assigned_user.user_name, 'user1')
+        self.assertEqual(self.fake.calls, ['get_entry', 'get_entry'])
+
+    def test_no_dict(self):
+        self.assertRaises(AttributeError, getattr, Lead(self.leads),
+                '__dict__')
+
+    def test_descriptors(self):
+        self.assertTrue(Lead.last_name is Lead.sugar_properties[1])
+        lead = self.leads.get('L01')
+        lead.load()
+        lead.last_name = 'changed'
+        self.assertEqual(lead.last_name, 'changed')
+        self.assertEqual(lead.get_post_dict(),
+                {'id': 'L01', 'last_name': 'changed'})
+
+    def test_property_helpers(self):
+        # deprecated, but still usable to wrap a field in a property
+        lead = self.leads.get('L01')
+        self.assertEqual(SugarPropertyGetter(Lead.last_name)(lead), 'n1')
+        SugarPropertySetter(Lead.status)(lead, 'Dead')
+        self.assertEqual(lead.get_post_dict(), {'id': 'L01', 'status': 'Dead'})
+
+    def test_modified_member_pinned(self):
+        lead = self.leads.get('L01')
+        lead.status = 'Dead'
+        for id in ('L02', 'L03', 'L04'):
+            self.leads.get(id)
+        self.assertTrue(self.leads.elements.get('L01') is lead)
+        self.assertEqual(lead.get_post_dict(),
+                {'id': 'L01', 'status': 'Dead'})
+
+    def test_modify_dropped_member(self):
+        lead = self.leads.get('L01')
+        for id in ('L02', 'L03'):
+            self.leads.get(id)
+        current = self.leads.get('L01')
+        self.assertTrue(current is not lead)
+        current.status = 'Dead'
+        self.assertRaises(SugarOperationnalError, setattr, lead, 'status',
+                'Converted')
+        self.assertEqual(self.leads.elements.dirty(), [current])
+        self.assertEqual(lead.get_post_dict(), {'id': 'L01'})
+
+    def test_reload_unpins(self):
+        lead = self.leads.get('L01')
+        lead.status = 'Dead'
+        lead.load()
+        self.assertFalse(lead.ismodified())
+        self.assertEqual(lead.status, 'New')
+        self.assertEqual(self.leads.elements.dirty(), [])
+
+    def test_post_unpins(self):
+        lead = self.leads.get('L01')
+        lead.status = 'Dead'
+        self.leads.post()
+        self.assertEqual(self.fake.data['Leads']['L01']['status'], 'Dead')
+        self.assertFalse(lead.ismodified())
+        self.assertEqual(self.leads.elements.dirty(), [])
+
+    def test_new_member(self):
+        lead = self.leads.add()
+        lead.last_name = 'new'
+        self.assertRaises(AttributeError, getattr, lead, 'status')
+        self.leads.post()
+        self.assertTrue(lead.id is not None)
+        self.assertEqual(self.leads.new_elements, [])
+        self.assertEqual(self.fake.data['Leads'][lead.id]['last_name'], 'new')
+
+class LoadTest(StoreTestCase):
+    def test_get_many(self):
+        leads = self.leads.get_many(['L01', 'L02', 'L01'])
+        self.assertEqual([lead.last_name for lead in leads],
+                ['n1', 'n2', 'n1'])
+        self.assertEqual(self.fake.calls, ['get_entries'])
+
+    def test_get_entries_selection(self):
+        entries = self.session.get_entries('Leads', ['L01', 'L02'],
+                ['last_name'])
+        self.assertEqual([(entry['id'], entry['last_name'])
+                for entry in entries], [('L01', 'n1'), ('L02', 'n2')])
+        self.assertEqual([entry.get('status') for entry in entries],
+                [None, None])
+
+    def test_get_entries_missing(self):
+        def unknown(request):
+            raise ValueError("Operation 'get_entries' is not defined "
+                    "in the WSDL for this service")
+        self.fake.fail['get_entries'] = unknown
+        leads = self.leads.get_many(['L01', 'L02'])
+        self.assertEqual(leads[1].last_name, 'n2')
+        self.assertFalse(self.store.use_get_entries)
+
+    def test_get_entries_fault(self):
+        def failing(request):
+            raise ValueError('Internal error')
+        self.fake.fail['get_entries'] = failing
+        self.assertRaises(SoapFault, self.leads.get_many, ['L01', 'L02'])
+        self.assertTrue(self.store.use_get_entries)
+
+    def test_query(self):
+        query = self.leads.get_by(status='New').filter(
+                date_entered__gte='2006-01-01')
+        self.assertEqual(query.compile()[0], "leads.status = 'New' AND "
+                "leads.date_entered >= '2006-01-01'")
+        query = self.leads.get_by(
+                date_entered__lt=datetime.date(2007, 1, 1), deleted=False)
+        self.assertEqual(query.compile()[0], "leads.date_entered < "
+                "'2007-01-01' AND leads.deleted = '0'")
+        leads = list(self.leads.get_by(status='New').limit(5))
+        self.assertEqual([lead.id for lead in leads],
+                ['L00', 'L01', 'L02', 'L03', 'L04'])
+
+    def test_quoting(self):
+        self.assertEqual(sql_quote("O'Brien"), "'O''Brien'")
+        # the quote ends the literal neither with nor without
+        # backslash escapes
+        self.assertEqual(sql_quote("x\\' OR 1=1 --"),
+                "'x\\\\'' OR 1=1 --'")
+        query = self.leads.get_by(last_name="O'Brien")
+        self.assertEqual(query.compile()[0],
+                "leads.last_name = 'O''Brien'")
+
+class BatchFaultTest(StoreTestCase):
+    def test_siblings_loaded(self):
+        self.leads.batch_fault_size = 3
+        leads = [self.leads.get('L%02d' % i) for i in range(6)]
+        self.assertEqual(leads[0].last_name, 'n0')
+        self.assertEqual(len([lead for lead in leads if lead.is_loaded()]), 4)
+        self.assertEqual([lead.last_name for lead in leads],
+                ['n0', 'n1', 'n2', 'n3', 'n4', 'n5'])
+        self.assertEqual(self.fake.calls, ['get_entries', 'get_entries'])
+        self.assertEqual(self.leads.unloaded, set())
+
+class PrefetchTest(StoreTestCase):
+    def user_names(self, leads):
+        return [lead.assigned_user.user_name for lead in leads]
+
+    def test_get_many(self):
+        leads = self.leads.get_many(['L01', 'L02', 'L03', 'L04'],
+                prefetch_related=['assigned_user'])
+        self.assertEqual(self.user_names(leads),
+                ['user1', 'user2', 'user0', 'user1'])
+        self.assertEqual(self.fake.calls, ['get_entries', 'get_entries'])
+
+    def test_new_members_skipped(self):
+        new = self.leads.add()
+        self.leads.prefetch_related([self.leads.get('L01'), new],
+                'assigned_user')
+        self.assertEqual(self.fake.calls, ['get_entries', 'get_entries'])
+
+    def test_projected_members(self):
+        # members loaded without the relation field get it in one call
+        leads = [self.leads.get(id) for id in ('L01', 'L02')]
+        for lead in leads:
+            lead.load(['last_name'])
+        del self.fake.calls[:]
+        self.leads.prefetch_related(leads, 'assigned_user')
+        self.assertEqual(self.user_names(leads), ['user1', 'user2'])
+        self.assertEqual(self.fake.calls, ['get_entries', 'get_entries'])
+
+    def test_query_only(self):
+        query = self.leads.get_by(status='New').only('last_name')
+        leads = list(query.limit(4).prefetch_related('assigned_user'))
+        self.assertEqual(self.user_names(leads),
+                ['user0', 'user1', 'user2', 'user0'])
+        self.assertEqual(self.fake.calls, ['get_entry_list', 'get_entries'])
+
+class ProjectionTest(StoreTestCase):
+    def test_load_fields(self):
+        lead = self.leads.get('L01')
+        lead.load(['last_name'])
+        self.assertTrue(loaded(lead, 'last_name'))
+        self.assertFalse(loaded(lead, 'status'))
+        # the missing fields are fetched together on first access
+        self.assertEqual(lead.status, 'New')
+        self.assertTrue(loaded(lead, 'date_entered'))
+        self.assertEqual(self.fake.calls, ['get_entry', 'get_entry'])
+
+    def test_query_only(self):
+        query = self.leads.get_by(status='New').only('last_name')
+        leads = list(query.limit(2))
+        self.assertEqual([lead.last_name for lead in leads], ['n0', 'n1'])
+        self.assertFalse(loaded(leads[0], 'status'))
+        self.assertEqual(self.fake.calls, ['get_entry_list'])
+
+    def test_query_defer(self):
+        query = self.leads.get_by(status='New').defer('last_name')
+        lead = list(query.limit(1))[0]
+        self.assertTrue(loaded(lead, 'status'))
+        self.assertFalse(loaded(lead, 'last_name'))
+
+    def test_adaptive_projection(self):
+        self.leads.adaptive_projection = True
+        self.assertEqual(self.leads.get('L01').last_name, 'n1')
+        lead = self.leads.get('L02')
+        self.assertEqual(lead.last_name, 'n2')
+        self.assertFalse(loaded(lead, 'status'))
+        self.assertEqual(self.leads.read_fields, set(['last_name']))
+
+class PostTest(StoreTestCase):
+    def add(self, count):
+        for i in range(count):
+            self.leads.add().last_name = 'new%d' % i
+
+    def test_concurrent(self):
+        self.leads.batch_size = 2
+        self.add(10)
+        progress = []
+        self.leads.post(callback=lambda module, posted, total:
+                progress.append((posted, total)), concurrency=3)
+        self.assertEqual(progress[-1], (10, 10))
+        self.assertEqual(self.leads.new_elements, [])
+        self.assertEqual(self.fake.calls.count('set_entries'), 5)
+
+    def test_concurrent_failure(self):
+        # the third batch fails: no more batches are sent, the ones
+        # that went through are finalized, the members of the failed
+        # and unsent ones are left new
+        self.leads.batch_size = 2
+        self.add(10)
+        batches = []
+        def fail_third(request):
+            batches.append(request)
+            if len(batches) == 3:
+                raise ValueError('out of memory')
+        self.fake.fail['set_entries'] = fail_third
+        self.assertRaises(SoapFault, self.leads.post, concurrency=3)
+        self.assertTrue(len(self.leads.new_elements) >= 2)
+        created = len(self.fake.data['Leads']) - 25
+        self.assertEqual(created, 10 - len(self.leads.new_elements))
+
+        del self.fake.fail['set_entries']
+        self.leads.post(concurrency=3)
+        self.assertEqual(self.leads.new_elements, [])
+        self.assertEqual(len(self.fake.data['Leads']), 35)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of the paging helpers and of the paged get_entry_list calls
+#
+import threading
+import unittest
+
+from pysugar import SugarSession
+from sugarpaging import iter_entries, SugarPagePrefetcher, \
+        SugarParallelExporter
+from tests.fakesugar import FakeSugar
+
+class Page(list):
+    total_count = None
+
+class Pages(object):
+    '''
+    a fetch function over the entries 0..count-1, logging the offsets
+    asked for. The page at fail_at raises.
+    '''
+    def __init__(self, count, total=False, fail_at=None):
+        self.count = count
+        self.total = total
+        self.fail_at = fail_at
+        self.offsets = []
+        self.lock = threading.Lock()
+
+    def __call__(self, offset, max_results):
+        self.lock.acquire()
+        try:
+            self.offsets.append(offset)
+        finally:
+            self.lock.release()
+        if offset == self.fail_at:
+            raise ValueError('page at %d' % offset)
+        page = Page(range(offset, min(offset + max_results, self.count)))
+        if self.total:
+            page.total_count = self.count
+        return page
+
+class IterPagesTest(unittest.TestCase):
+    def test_iter_entries(self):
+        for prefetch in (False, True):
+            fetch = Pages(45)
+            self.assertEqual(list(iter_entries(fetch, 10, prefetch=prefetch)),
+                    range(45))
+            self.assertEqual(fetch.offsets, [0, 10, 20, 30, 40])
+
+    def test_full_last_page(self):
+        fetch = Pages(20)
+        self.assertEqual(list(iter_entries(fetch, 10)), range(20))
+        self.assertEqual(fetch.offsets, [0, 10, 20])
+
+    def test_error(self):
+        entries = iter_entries(Pages(45, fail_at=20), 10)
+        self.assertRaises(ValueError, list, entries)
+
+    def test_prefetcher_close(self):
+        # the prefetcher stays one page ahead and stops when closed
+        fetch = Pages(1000)
+        prefetcher = SugarPagePrefetcher(fetch, 10)
+        pages = iter(prefetcher)
+        self.assertEqual(pages.next(), range(10))
+        prefetcher.close()
+        prefetcher.thread.join(1)
+        self.assertFalse(prefetcher.thread.isAlive())
+        self.assertTrue(len(fetch.offsets) <= 3)
+
+class ParallelExporterTest(unittest.TestCase):
+    def test_unknown_total(self):
+        fetch = Pages(95)
+        exporter = SugarParallelExporter(fetch, 10, workers=3)
+        self.assertEqual(list(exporter), range(95))
+        self.assertEqual(sorted(fetch.offsets)[:10], range(0, 100, 10))
+
+    def test_known_total(self):
+        fetch = Pages(95, total=True)
+        exporter = SugarParallelExporter(fetch, 10, workers=3)
+        self.assertEqual(list(exporter), range(95))
+        self.assertEqual(sorted(fetch.offsets), range(0, 100, 10))
+
+    def test_max_in_flight(self):
+        fetch = Pages(1000, total=True)
+        exporter = SugarParallelExporter(fetch, 10, workers=2,
+                max_in_flight=2)
+        pages = exporter.iter_pages()
+        pages.next()
+        pages.next()
+        exporter.stop()
+        # the first page, the one consumed and two in flight
+        self.assertTrue(len(fetch.offsets) <= 4)
+
+    def test_error(self):
+        exporter = SugarParallelExporter(Pages(95, fail_at=50), 10,
+                workers=3)
+        self.assertRaises(ValueError, list, exporter)
+
+class SessionPagingTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        url = self.fake.start()
+        self.session = SugarSession('u', 'p', url, debug=False)
+        self.ids = sorted(self.fake.data['Leads'])
+        del self.fake.calls[:]
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_iter_entry_list(self):
+        entries = self.session.iter_entry_list('Leads', page_size=10)
+        self.assertEqual([entry['id'] for entry in entries], self.ids)
+        self.assertEqual(self.fake.calls, ['get_entry_list'] * 3)
+
+    def test_export_entry_list(self):
+        entries = self.session.export_entry_list('Leads', page_size=10,
+                workers=2)
+        self.assertEqual([entry['id'] for entry in entries], self.ids)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
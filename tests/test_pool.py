@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of the session pool and of the priority scheduler
+#
+import socket
+import threading
+import unittest
+
+from sugarpool import SugarSessionPool, SugarPriorityScheduler, \
+        SugarPoolTimeoutError, Bulk, Interactive
+from tests.fakesugar import FakeSugar
+
+def broken(*args):
+    raise socket.error('connection refused')
+
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        self.url = self.fake.start()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def pool(self, **args):
+        return SugarSessionPool('u', 'p', self.url, **args)
+
+    def test_reuse(self):
+        pool = self.pool(size=2)
+        with pool.session() as session:
+            first = session
+        with pool.session() as session:
+            self.assertTrue(session is first)
+        stats = pool.get_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['busy'], 0)
+
+    def test_timeout(self):
+        pool = self.pool(size=1, wait_timeout=0.1)
+        session = pool.checkout()
+        self.assertRaises(SugarPoolTimeoutError, pool.checkout)
+        pool.checkin(session)
+        pool.checkin(pool.checkout())
+        self.assertEqual(pool.get_stats()['timeouts'], 1)
+
+    def test_relogin(self):
+        pool = self.pool(size=1, check_interval=0)
+        with pool.session() as session:
+            session.get_entry('Leads', 'L01', ['status'])
+        self.fake.sessions.clear()
+        with pool.session() as session:
+            session.get_entry('Leads', 'L01', ['status'])
+        self.assertEqual(pool.get_stats()['relogins'], 1)
+
+    def test_failed_health_check(self):
+        # a session whose check fails with a socket error is dropped
+        # and its slot freed
+        pool = self.pool(size=2, wait_timeout=0.5, check_interval=0)
+        kept = pool.checkout()
+        dropped = pool.checkout()
+        pool.checkin(dropped)
+        dropped.get_user_id = broken
+        session = pool.checkout()
+        self.assertTrue(session is not dropped)
+        stats = pool.get_stats()
+        self.assertEqual(stats['open'], 2)
+        self.assertEqual(stats['discarded'], 1)
+        pool.checkin(session)
+        pool.checkin(kept)
+        self.assertEqual(pool.get_stats()['idle'], 2)
+
+    def test_close(self):
+        pool = self.pool(size=2)
+        session = pool.checkout()
+        pool.checkin(pool.checkout())
+        pool.close()
+        pool.checkin(session)
+        self.assertEqual(self.fake.calls.count('logout'), 2)
+        self.assertEqual(pool.get_stats()['open'], 0)
+
+class PrioritySchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        url = self.fake.start()
+        self.pool = SugarSessionPool('u', 'p', url, size=2)
+        self.scheduler = SugarPriorityScheduler(self.pool, reserved=1)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_reserved(self):
+        bulk = self.scheduler.checkout(Bulk)
+        self.assertRaises(SugarPoolTimeoutError,
+                self.scheduler.checkout, Bulk, 0.1)
+        interactive = self.scheduler.checkout(Interactive, 0.1)
+        self.scheduler.checkin(interactive)
+        self.scheduler.checkin(bulk)
+        stats = self.scheduler.get_stats()
+        self.assertEqual(stats[Bulk]['timeouts'], 1)
+        self.assertEqual(stats[Bulk]['busy'], 0)
+        self.assertEqual(stats[Interactive]['checkouts'], 1)
+
+    def test_timeout_left_for_the_pool(self):
+        # the pool only gets the time that waiting for the turn left
+        timeouts = []
+        checkout = self.pool.checkout
+        def record(timeout=None):
+            timeouts.append(timeout)
+            return checkout(timeout)
+        self.pool.checkout = record
+
+        held = [self.scheduler.checkout(), self.scheduler.checkout()]
+        timer = threading.Timer(0.2, self.scheduler.checkin, [held.pop()])
+        timer.start()
+        session = self.scheduler.checkout(Interactive, 1.0)
+        timer.join()
+        self.assertTrue(timeouts[-1] <= 0.85)
+        self.scheduler.checkin(session)
+        self.scheduler.checkin(held.pop())
+        self.assertEqual(self.scheduler.get_stats()[Interactive]['busy'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
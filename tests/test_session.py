@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of SugarSession: connection, session reuse and shared reads
+#
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from pysugar import SugarSession, SugarSessionStore, \
+        SugarInvalidSessionError
+from tests.fakesugar import FakeSugar
+
+try:
+    from django.conf import settings
+    from sugarHelper import SugarSingleton
+except ImportError:
+    settings = None
+
+class Blocker(object):
+    '''
+    a fail hook holding the first request until released
+    '''
+    def __init__(self):
+        self.received = threading.Event()
+        self.released = threading.Event()
+        self.count = 0
+
+    def __call__(self, request):
+        self.count += 1
+        if self.count == 1:
+            self.received.set()
+            self.released.wait(5)
+
+class SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        self.url = self.fake.start()
+        self.session = SugarSession('u', 'p', self.url, debug=False)
+        del self.fake.calls[:]
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def in_thread(self, fn, *args):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fn(*args)))
+        thread.start()
+        return thread, results
+
+class ConnectTest(SessionTestCase):
+    def setUp(self):
+        SessionTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.store = SugarSessionStore(os.path.join(self.dir, 'sessions'))
+
+    def tearDown(self):
+        SessionTestCase.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def connect(self, **args):
+        return SugarSession('u', 'p', self.url, debug=False, **args)
+
+    def test_probes(self):
+        self.connect()
+        self.assertEqual(self.fake.calls, ['get_gmt_time', 'login'])
+
+    def test_fast_connect(self):
+        session = self.connect(fast_connect=True)
+        self.assertEqual(self.fake.calls, [])
+        session.get_entry('Leads', 'L01', ['status'])
+        self.assertEqual(self.fake.calls, ['login', 'get_entry'])
+
+    def test_session_store(self):
+        self.connect(session_store=self.store)
+        self.assertEqual(self.fake.calls.count('login'), 1)
+        mode = os.stat(self.store.path).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0600)
+
+        del self.fake.calls[:]
+        session = self.connect(fast_connect=True, session_store=self.store)
+        session.get_entry('Leads', 'L01', ['status'])
+        self.assertEqual(self.fake.calls, ['get_user_id', 'get_entry'])
+
+    def test_stale_stored_session(self):
+        self.connect(session_store=self.store)
+        self.fake.sessions.clear()
+        del self.fake.calls[:]
+        session = self.connect(fast_connect=True, session_store=self.store)
+        session.get_entry('Leads', 'L01', ['status'])
+        self.assertEqual(self.fake.calls, ['get_user_id', 'login',
+                'get_entry'])
+        self.assertEqual(self.store.get(self.url, 'u'), session._session_id)
+
+class ReloginTest(SessionTestCase):
+    def test_relogin(self):
+        self.fake.sessions.clear()
+        self.assertEqual(self.session.get_entry('Leads', 'L01',
+                ['status'])['status'], 'New')
+        self.assertEqual(self.fake.calls, ['get_entry', 'login',
+                'get_entry'])
+
+    def test_no_relogin(self):
+        self.session.relogin = False
+        self.fake.sessions.clear()
+        self.assertRaises(SugarInvalidSessionError, self.session.get_entry,
+                'Leads', 'L01', ['status'])
+
+@unittest.skipIf(settings is None, 'Django is not installed')
+class SingletonTest(SessionTestCase):
+    def setUp(self):
+        SessionTestCase.setUp(self)
+        if not settings.configured:
+            settings.configure()
+        settings.SUGAR_USE_DEV_SERVER = True
+        settings.SUGAR_DEV_USER = 'u'
+        settings.SUGAR_DEV_PASS = 'p'
+        settings.SUGAR_DEV_URL = self.url
+        settings.SUGAR_CHECK_INTERVAL = 60
+        SugarSingleton.instance = None
+
+    def tearDown(self):
+        SugarSingleton.instance = None
+        SessionTestCase.tearDown(self)
+
+    def test_checked_after_interval(self):
+        session = SugarSingleton.getInstance()
+        del self.fake.calls[:]
+        self.assertTrue(SugarSingleton.getInstance() is session)
+        self.assertEqual(self.fake.calls, [])
+        SugarSingleton.checked_at -= 60
+        self.assertTrue(SugarSingleton.getInstance() is session)
+        self.assertEqual(self.fake.calls, ['get_user_id'])
+
+    def test_relogin_on_check(self):
+        session = SugarSingleton.getInstance()
+        self.fake.sessions.clear()
+        del self.fake.calls[:]
+        SugarSingleton.checked_at -= 60
+        self.assertTrue(SugarSingleton.getInstance() is session)
+        # in debug mode, the login checks the new session id
+        self.assertEqual(self.fake.calls, ['get_user_id', 'login',
+                'get_user_id'])
+
+class SingleFlightTest(SessionTestCase):
+    def get_status(self):
+        return self.session.get_entry('Leads', 'L01', ['status'])['status']
+
+    def test_shared(self):
+        blocker = self.fake.fail['get_entry'] = Blocker()
+        first, firsts = self.in_thread(self.get_status)
+        blocker.received.wait(5)
+        second, seconds = self.in_thread(self.get_status)
+        while not self.session.single_flight.get_stats()['saved']:
+            second.join(0.01)
+        blocker.released.set()
+        first.join()
+        second.join()
+        self.assertEqual(firsts + seconds, ['New', 'New'])
+        self.assertEqual(self.fake.calls, ['get_entry'])
+
+    def test_read_after_own_write(self):
+        # a read started before the session wrote is not shared with
+        # the reads made after the write
+        blocker = self.fake.fail['get_entry'] = Blocker()
+        first, firsts = self.in_thread(self.get_status)
+        blocker.received.wait(5)
+        self.session.set_entry('Leads', {'id': 'L01', 'status': 'Dead'})
+        self.assertEqual(self.get_status(), 'Dead')
+        blocker.released.set()
+        first.join()
+        self.assertEqual(self.fake.calls, ['get_entry', 'set_entry',
+                'get_entry'])
+        self.assertEqual(self.session.single_flight.get_stats()['saved'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4:
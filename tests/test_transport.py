@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# License: PSF
+# see: LICENSE
+# for full text of the license
+#
+# Tests of the keep-alive connection pool and of the entry list streams
+#
+import gc
+import httplib
+import socket
+import threading
+import unittest
+
+from pysugar import SugarSession
+from sugartransport import SugarConnectionPool, SugarTransportError
+from tests.fakesugar import FakeSugar
+
+class RawServer(object):
+    '''
+    An HTTP server answering 'ok' to the first answered requests of
+    each connection, then doing what misbehave says: 'close' closes
+    the connection without answering, 'hang' never answers.
+    '''
+    def __init__(self, misbehave, answered=1):
+        self.misbehave = misbehave
+        self.answered = answered
+        self.requests = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'http://127.0.0.1:%d/' % self.sock.getsockname()[1]
+        self.done = threading.Event()
+        thread = threading.Thread(target=self.serve)
+        thread.setDaemon(True)
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error:
+                # stopped
+                return
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def handle(self, conn):
+        rfile = conn.makefile('rb')
+        served = 0
+        try:
+            while True:
+                line = rfile.readline()
+                if not line:
+                    return
+                length = 0
+                while True:
+                    header = rfile.readline()
+                    if header in ('\r\n', ''):
+                        break
+                    name, value = header.split(':', 1)
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                rfile.read(length)
+                self.requests += 1
+                if served >= self.answered:
+                    if self.misbehave == 'hang':
+                        self.done.wait(5)
+                    return
+                served += 1
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+        finally:
+            rfile.close()
+            conn.close()
+
+    def stop(self):
+        self.done.set()
+        self.sock.close()
+
+class ConnectionPoolTest(unittest.TestCase):
+    def request(self, pool, url):
+        response = pool.request(url, 'body')
+        try:
+            return response.read()
+        finally:
+            response.release()
+
+    def test_reuse(self):
+        server = RawServer('close', answered=10)
+        pool = SugarConnectionPool()
+        try:
+            for i in range(3):
+                self.assertEqual(self.request(pool, server.url), 'ok')
+        finally:
+            server.stop()
+        stats = pool.get_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['busy'], 0)
+
+    def test_retry_when_closed_without_answer(self):
+        # the kept alive connection is closed by the server when the
+        # second request comes, it is sent again on a new connection
+        server = RawServer('close')
+        pool = SugarConnectionPool()
+        try:
+            self.assertEqual(self.request(pool, server.url), 'ok')
+            self.assertEqual(self.request(pool, server.url), 'ok')
+        finally:
+            server.stop()
+        self.assertEqual(pool.get_stats()['retried'], 1)
+        self.assertEqual(server.requests, 3)
+
+    def test_no_retry_after_timeout(self):
+        server = RawServer('hang')
+        pool = SugarConnectionPool(timeout=0.3)
+        try:
+            self.request(pool, server.url)
+            self.assertRaises(socket.timeout, self.request, pool, server.url)
+        finally:
+            server.stop()
+        self.assertEqual(pool.get_stats()['retried'], 0)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(pool.get_stats()['busy'], 0)
+
+    def test_no_retry_on_new_connection(self):
+        server = RawServer('close', answered=0)
+        pool = SugarConnectionPool()
+        try:
+            self.assertRaises(httplib.BadStatusLine,
+                    self.request, pool, server.url)
+        finally:
+            server.stop()
+        self.assertEqual(server.requests, 1)
+
+    def test_wait_timeout(self):
+        server = RawServer('close', answered=10)
+        pool = SugarConnectionPool(max_per_host=1, wait_timeout=0.1)
+        try:
+            response = pool.request(server.url, 'body')
+            self.assertRaises(SugarTransportError,
+                    pool.request, server.url, 'body')
+            response.read()
+            response.release()
+            self.assertEqual(self.request(pool, server.url), 'ok')
+        finally:
+            server.stop()
+
+class EntryListStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSugar()
+        url = self.fake.start()
+        self.pool = SugarConnectionPool(max_per_host=2, wait_timeout=2)
+        self.session = SugarSession('u', 'p', url, debug=False,
+                connection_pool=self.pool)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def stream(self):
+        return self.session.stream_entry_list('Leads', '', '', 0, '', 10, 0)
+
+    def test_exhausted(self):
+        stream = self.stream()
+        self.assertEqual(len(list(stream)), 10)
+        self.assertEqual(stream.result_count, 10)
+        self.assertEqual(stream.next_offset, 10)
+        self.assertEqual(self.pool.get_stats()['busy'], 0)
+
+    def test_with_block(self):
+        for i in range(4):
+            with self.stream() as stream:
+                for item in stream:
+                    break
+        self.assertEqual(self.pool.get_stats()['busy'], 0)
+
+    def test_garbage_collected(self):
+        for i in range(4):
+            for item in self.stream():
+                break
+            gc.collect()
+        self.assertEqual(self.pool.get_stats()['busy'], 0)
+        self.assertEqual(len(self.session.get_entry_list('Leads', '', '',
+                0, '', 5, 0)), 5)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab tabstop=4 shiftwidth=4: